@@ -0,0 +1,339 @@
+import argparse
+import heapq
+import math
+import random
+import sys
+import time
+
+import numpy as np
+
+from layout_io import read_layout
+from validate_layout import segment_distance
+
+# Circles may overlap by this much, to allow for the rounding of their
+# coordinates to two decimal places; as in validate_layout.py.
+TOLERANCE = 0.01
+
+def inside_region(x, y, segments):
+    """Return whether the points (x, y) are inside the region.
+
+    The region is bounded by segments, which form closed polygons: the
+    outer boundary and any holes in it. A point is inside if a ray from
+    it to the right crosses an odd number of segments.
+    """
+    inside = np.zeros(len(x), dtype=bool)
+    for x1, y1, x2, y2 in segments:
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        crossing_x = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < crossing_x)
+    return inside
+
+def segments_distance(x, y, segments):
+    """Return the distance of the points (x, y) from the nearest segment."""
+    distance = np.full(len(x), np.inf)
+    for ux, uy, vx, vy in segments:
+        l2 = (ux - vx)**2 + (uy - vy)**2
+        if l2 == 0:
+            t = np.zeros(len(x))
+        else:
+            t = np.clip(((x - ux) * (vx - ux) + (y - uy) * (vy - uy)) / l2,
+                        0, 1)
+        distance = np.minimum(distance, np.hypot(ux + t * (vx - ux) - x,
+                                                 uy + t * (vy - uy) - y))
+    return distance
+
+def hex_packing(items, radius, segments):
+    """Place equal circles on a hexagonal lattice.
+
+    The lattice has a circle at (0, 0). Without segments we keep the
+    items lattice circles closest to (0, 0); with segments, the lattice
+    circles inside the region, closest to (0, 0) first. We compute the
+    whole lattice with array operations, so there is no need to check
+    each circle against its neighbors.
+
+    Returns
+    -------
+    circles : np.ndarray
+        An N x 3 array of the circles we placed
+    """
+    dx = 2 * radius
+    # Rounding the row distance brings circles closer by at most 0.005,
+    # well within TOLERANCE.
+    dy = round(radius * math.sqrt(3), 2)
+    if len(segments) > 0:
+        min_x = min(segments[:, 0].min(), segments[:, 2].min())
+        max_x = max(segments[:, 0].max(), segments[:, 2].max())
+        min_y = min(segments[:, 1].min(), segments[:, 3].min())
+        max_y = max(segments[:, 1].max(), segments[:, 3].max())
+    else:
+        # A disk with about twice the area the items need.
+        extent = math.sqrt(2 * items * dx * dy / math.pi) + dx
+        min_x = min_y = -extent
+        max_x = max_y = extent
+    rows = np.arange(math.floor(min_y / dy), math.ceil(max_y / dy) + 1)
+    columns = np.arange(math.floor(min_x / dx) - 1, math.ceil(max_x / dx) + 1)
+    x = (columns[np.newaxis, :] * dx
+         + (rows[:, np.newaxis] % 2) * radius).ravel()
+    y = np.broadcast_to(rows[:, np.newaxis] * dy,
+                        (len(rows), len(columns))).ravel()
+    x = np.round(x, 2)
+    y = np.round(y, 2)
+    if len(segments) > 0:
+        valid = (inside_region(x, y, segments)
+                 & (segments_distance(x, y, segments) >= radius - TOLERANCE))
+        x = x[valid]
+        y = y[valid]
+    order = np.argsort(np.hypot(x, y), kind='stable')
+    if items is not None:
+        order = order[:items]
+    return np.column_stack((x[order], y[order],
+                            np.full(len(order), radius)))
+
+class SpatialHash:
+    """A uniform grid over the circles placed so far and the segments.
+
+    The cells are twice the largest radius, so a new circle can only
+    overlap circles and segments in its own cell and the eight cells
+    around it. Each cell holds both the circles, as (x, y, r) tuples,
+    and the segments, as (x1, y1, x2, y2) tuples, so that checking a
+    cell takes a single lookup.
+    """
+
+    def __init__(self, max_radius, segments):
+        self.cell_size = 2 * max_radius
+        self.cells = {}
+        self.circles = []
+        half_cell = self.cell_size / 2
+        for segment in segments.tolist():
+            ux, uy, vx, vy = segment
+            samples = math.ceil(math.hypot(vx - ux, vy - uy) / half_cell)
+            cells = set()
+            for k in range(samples + 1):
+                t = k / samples if samples > 0 else 0
+                cells.add(self.cell(ux + t * (vx - ux), uy + t * (vy - uy)))
+            for cell in cells:
+                self.cells.setdefault(cell, []).append(tuple(segment))
+
+    def cell(self, x, y):
+        return (math.floor(x / self.cell_size),
+                math.floor(y / self.cell_size))
+
+    def fits(self, x, y, r):
+        """Return whether circle (x, y, r) overlaps no circle or segment."""
+        cx, cy = self.cell(x, y)
+        cells = self.cells
+        hypot = math.hypot
+        for cell in ((cx, cy), (cx - 1, cy), (cx + 1, cy), (cx, cy - 1),
+                     (cx, cy + 1), (cx - 1, cy - 1), (cx + 1, cy - 1),
+                     (cx - 1, cy + 1), (cx + 1, cy + 1)):
+            for item in cells.get(cell, ()):
+                if len(item) == 3:
+                    if hypot(item[0] - x, item[1] - y) < (r + item[2]
+                                                          - TOLERANCE):
+                        return False
+                elif segment_distance(x, y, item) < r - TOLERANCE:
+                    return False
+        return True
+
+    def add(self, x, y, r):
+        circle = (x, y, r)
+        self.cells.setdefault(self.cell(x, y), []).append(circle)
+        self.circles.append(circle)
+
+    def near(self, x, y, reach):
+        """Return the circles whose centers may be within reach of (x, y)."""
+        cx, cy = self.cell(x, y)
+        k = math.ceil(reach / self.cell_size)
+        cells = self.cells
+        return [ item
+                 for dx in range(-k, k + 1)
+                 for dy in range(-k, k + 1)
+                 for item in cells.get((cx + dx, cy + dy), ())
+                 if len(item) == 3 ]
+
+def tangent_centers(m, n, r):
+    """Return the centers of the circles of radius r tangent to m and n."""
+    mx, my, rm = m
+    nx, ny, rn = n
+    dx = nx - mx
+    dy = ny - my
+    d2 = dx**2 + dy**2
+    if d2 == 0:
+        return []
+    r1 = rm + r
+    r2 = rn + r
+    lam = (r1**2 - r2**2 + d2) / (2 * d2)
+    e2 = r1**2 / d2 - lam**2
+    if e2 < 0:
+        return []
+    e = math.sqrt(e2)
+    return [(mx + lam * dx - e * dy, my + lam * dy + e * dx),
+            (mx + lam * dx + e * dy, my + lam * dy - e * dx)]
+
+def start_point(radius, segments, grid):
+    """Return the point closest to (0, 0) where a circle of radius fits."""
+    if grid.fits(0, 0, radius) and (len(segments) == 0 or inside_region(
+            np.zeros(1), np.zeros(1), segments)[0]):
+        return 0, 0
+    candidates = hex_packing(None, radius, segments)
+    if len(candidates) == 0:
+        return None
+    return tuple(candidates[0, :2])
+
+def greedy_packing(items, min_radius, max_radius, segments):
+    """Place circles of random radii, each tangent to two placed circles.
+
+    As in the assignment, we grow the packing from (0, 0): we take the
+    placed circle closest to (0, 0) that may still have room next to
+    it, and put the new circle tangent to it and to one of its
+    neighbors that still have room, at the free position closest to
+    (0, 0). If there is no such position, the circle is retired and we
+    try the next one.
+    The spatial hash makes each check take constant time.
+
+    Returns
+    -------
+    circles : list
+        The (x, y, r) tuples of the circles we placed
+    """
+    grid = SpatialHash(max_radius, segments)
+    r = round(random.uniform(min_radius, max_radius), 2)
+    start = start_point(r, segments, grid)
+    if start is None:
+        return []
+    grid.add(round(start[0], 2), round(start[1], 2), r)
+    # The circles that may have room next to them, closest to (0, 0)
+    # first, and earliest placed first among equals.
+    active = [(round(math.hypot(*start), 2), 0)]
+    # The circles that have no room next to them. Positions tangent to
+    # them are mostly taken, so we do not try them.
+    retired = set()
+    while len(active) > 0 and (items is None or len(grid.circles) < items):
+        r = round(random.uniform(min_radius, max_radius), 2)
+        placed = False
+        while len(active) > 0 and not placed:
+            _, m_index = active[0]
+            m = grid.circles[m_index]
+            # We check the candidate positions closest to (0, 0) first,
+            # so we can stop at the first one that fits.
+            candidates = []
+            reach = m[2] + 2 * r + max_radius
+            for n in grid.near(m[0], m[1], reach):
+                if n is m or n in retired:
+                    continue
+                for x, y in tangent_centers(m, n, r):
+                    candidates.append((round(math.hypot(x, y), 2),
+                                       round(x, 2), round(y, 2)))
+            candidates.sort()
+            best = None
+            for candidate in candidates:
+                if grid.fits(candidate[1], candidate[2], r):
+                    best = candidate
+                    break
+            if best is None and len(grid.circles) == 1:
+                # Nothing to be tangent to yet but m itself.
+                x = round(m[0] + m[2] + r, 2)
+                if grid.fits(x, m[1], r):
+                    best = (round(math.hypot(x, m[1]), 2), x, m[1])
+            if best is None:
+                heapq.heappop(active)
+                retired.add(m)
+                continue
+            distance, x, y = best
+            heapq.heappush(active, (distance, len(grid.circles)))
+            grid.add(x, y, r)
+            placed = True
+    return grid.circles
+
+def pack(items, min_radius, max_radius, segments):
+    if min_radius == max_radius:
+        return [ tuple(circle) for circle in
+                 hex_packing(items, min_radius, segments).tolist() ]
+    return greedy_packing(items, min_radius, max_radius, segments)
+
+def write_layout(output_file, circles, segments):
+    with open(output_file, 'w') as layout_file:
+        for x, y, r in circles:
+            layout_file.write('{:.2f} {:.2f} {:.2f}\n'.format(x, y, r))
+        for x1, y1, x2, y2 in segments.tolist():
+            layout_file.write('{} {} {} {}\n'.format(x1, y1, x2, y2))
+
+def square_with_holes(side):
+    """Return the segments of a square with two rectangular holes,
+    shaped as square_holes.txt, with the given side."""
+    a = side / 2
+    b = side / 4
+    c = side / 8
+    squares = [(-a, -a, a, a), (-b, c, b, b), (-b, -b, b, -c)]
+    segments = []
+    for x1, y1, x2, y2 in squares:
+        segments += [(x2, y2, x1, y2), (x1, y2, x1, y1),
+                     (x1, y1, x2, y1), (x2, y1, x2, y2)]
+    holes_area = 2 * (2 * b) * (b - c)
+    return np.array(segments), side**2 - holes_area
+
+def benchmark(sizes, radius, min_radius, max_radius, seed):
+    """Fill shapes sized for about size circles and print the achieved
+    density, the fraction of the area the circles cover, against time.
+    """
+    print('{:>10} {:>8} {:>10} {:>8} {:>10}'.format(
+        'size', 'radii', 'placed', 'density', 'seconds'))
+    for size in sizes:
+        for name, low, high in [('equal', radius, radius),
+                                ('random', min_radius, max_radius)]:
+            random.seed(seed)
+            mean_area = math.pi * (low**2 + low * high + high**2) / 3
+            segments, area = square_with_holes(
+                math.sqrt(size * mean_area / 0.8 * 1.2))
+            start = time.perf_counter()
+            circles = pack(None, low, high, segments)
+            elapsed = time.perf_counter() - start
+            covered = sum(math.pi * r**2 for (_, _, r) in circles)
+            print('{:>10} {:>8} {:>10} {:>8.3f} {:>10.2f}'.format(
+                size, name, len(circles), covered / area, elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack circles in a shape')
+    parser.add_argument("-i", "--items", type=int,
+                        help="number of circles to place")
+    parser.add_argument("-r", "--radius", type=float,
+                        help="radius of all circles")
+    parser.add_argument("--min_radius", type=float,
+                        help="minimum radius of random circles")
+    parser.add_argument("--max_radius", type=float,
+                        help="maximum radius of random circles")
+    parser.add_argument("-b", "--boundary_file",
+                        help="segments bounding the shape to fill")
+    parser.add_argument("-s", "--seed", type=int,
+                        help="random seed")
+    parser.add_argument("--benchmark", nargs='+', type=int,
+                        help="instead of packing, report density against "
+                        "time for about these many circles; uses "
+                        "--radius, --min_radius and --max_radius")
+    parser.add_argument("output_file", nargs='?', help="output file")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.benchmark:
+        benchmark(args.benchmark, args.radius or 10, args.min_radius or 5,
+                  args.max_radius or 10, args.seed or 42)
+        sys.exit(0)
+    if args.output_file is None:
+        parser.error('the output file is required')
+    if args.radius is not None:
+        min_radius = max_radius = args.radius
+    elif args.min_radius is not None and args.max_radius is not None:
+        min_radius, max_radius = args.min_radius, args.max_radius
+    else:
+        parser.error('give either --radius or --min_radius and --max_radius')
+    segments = np.empty((0, 4))
+    if args.boundary_file:
+        _, segments = read_layout(args.boundary_file)
+    elif args.items is None:
+        parser.error('without a boundary file, --items is required')
+    circles = pack(args.items, min_radius, max_radius, segments)
+    write_layout(args.output_file, circles, segments)
+    print(len(circles))
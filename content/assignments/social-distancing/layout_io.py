@@ -0,0 +1,97 @@
+import numpy as np
+
+# The amount of input we parse at a time.
+CHUNK_SIZE = 2**22
+
+def parse_layout(text):
+    """Parse a block of whole lines of the layout format.
+
+    Lines with three numbers are circles, x y r, and lines with four
+    numbers are segments, x1 y1 x2 y2; any other lines are ignored.
+    Instead of splitting each line, we find where the numbers start in
+    the whole block, count how many numbers each line has, and convert
+    all numbers at once.
+
+    Parameters
+    ----------
+    text : bytes
+        the lines to parse
+
+    Returns
+    -------
+    circles, segments : np.ndarray, np.ndarray
+        An N x 3 array of circles and an M x 4 array of segments
+    """
+    data = np.frombuffer(text, dtype=np.uint8)
+    # Whitespace and control characters are all at most ' '.
+    is_space = data <= ord(' ')
+    starts = ~is_space
+    starts[1:] &= is_space[:-1]
+    # The line of each number is the number of newlines before it.
+    newlines = np.flatnonzero(data == ord('\n'))
+    token_lines = np.searchsorted(newlines, np.flatnonzero(starts))
+    fields = np.bincount(token_lines)[token_lines]
+    values = np.fromstring(text, dtype=np.float64, sep=' ')
+    circles = values[fields == 3].reshape(-1, 3)
+    segments = values[fields == 4].reshape(-1, 4)
+    return circles, segments
+
+def iter_layout(filename, chunk_size=CHUNK_SIZE):
+    """Yield the circles and the segments of filename a chunk at a time.
+
+    Each chunk ends at a line boundary, so memory use depends on
+    chunk_size, not on the size of the file.
+    """
+    remainder = b''
+    with open(filename, 'rb') as input_file:
+        while True:
+            block = input_file.read(chunk_size)
+            if not block:
+                break
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            if end > 0:
+                yield parse_layout(block[:end])
+    if remainder:
+        yield parse_layout(remainder)
+
+def read_layout(filename, chunk_size=CHUNK_SIZE):
+    """Return all the circles and the segments of filename."""
+    circles = [np.empty((0, 3))]
+    segments = [np.empty((0, 4))]
+    for chunk_circles, chunk_segments in iter_layout(filename, chunk_size):
+        circles.append(chunk_circles)
+        segments.append(chunk_segments)
+    return np.concatenate(circles), np.concatenate(segments)
+
+def layout_bounds(circles, segments):
+    """Return the bounding box of circles and segments.
+
+    Returns
+    -------
+    min_x, min_y, max_x, max_y : float, float, float, float
+        The bounds; if there are no circles and no segments, min_x and
+        min_y are infinite and max_x and max_y minus infinite
+    """
+    xs = [circles[:, 0] - circles[:, 2], circles[:, 0] + circles[:, 2],
+          segments[:, 0], segments[:, 2]]
+    ys = [circles[:, 1] - circles[:, 2], circles[:, 1] + circles[:, 2],
+          segments[:, 1], segments[:, 3]]
+    xs = np.concatenate(xs)
+    ys = np.concatenate(ys)
+    if len(xs) == 0:
+        return np.inf, np.inf, -np.inf, -np.inf
+    return xs.min(), ys.min(), xs.max(), ys.max()
+
+def read_bounds(filename, chunk_size=CHUNK_SIZE):
+    """Return the bounding box of filename, reading it a chunk at a time."""
+    min_x = min_y = np.inf
+    max_x = max_y = -np.inf
+    for circles, segments in iter_layout(filename, chunk_size):
+        bounds = layout_bounds(circles, segments)
+        min_x = min(min_x, bounds[0])
+        min_y = min(min_y, bounds[1])
+        max_x = max(max_x, bounds[2])
+        max_y = max(max_y, bounds[3])
+    return min_x, min_y, max_x, max_y
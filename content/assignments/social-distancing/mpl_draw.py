@@ -3,61 +3,166 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 from matplotlib import collections  as mc
-from matplotlib.patches import Circle
 
-import sys
+import numpy as np
+
+from layout_io import iter_layout, read_bounds, read_layout, layout_bounds
 
 import argparse
+import math
+import os
+import tempfile
+
+def circle_collection(circles, transform):
+    """Return a collection drawing circles, an N x 3 (or wider) array."""
+    diameters = 2 * circles[:, 2]
+    return mc.EllipseCollection(diameters, diameters, 0, units='xy',
+                                offsets=circles[:, :2],
+                                offset_transform=transform,
+                                edgecolors='black', facecolors='none',
+                                linewidths=1)
+
+def segment_collection(segments):
+    sc = mc.LineCollection(segments.reshape(-1, 2, 2), colors='black',
+                           linewidths=1)
+    sc.set_capstyle('round')
+    return sc
+
+def bucket_circles(circles, tiles_dir, min_x, min_y, tile_width,
+                   rows, columns):
+    """Append each circle to the file of every tile it overlaps."""
+    if len(circles) == 0:
+        return
+    x, y, r = circles[:, 0], circles[:, 1], circles[:, 2]
+    first_column = np.clip((x - r - min_x) // tile_width, 0, columns - 1)
+    last_column = np.clip((x + r - min_x) // tile_width, 0, columns - 1)
+    first_row = np.clip((y - r - min_y) // tile_width, 0, rows - 1)
+    last_row = np.clip((y + r - min_y) // tile_width, 0, rows - 1)
+    span = int(max((last_column - first_column).max(),
+                   (last_row - first_row).max()))
+    for dc in range(span + 1):
+        for dr in range(span + 1):
+            overlaps = ((first_column + dc <= last_column)
+                        & (first_row + dr <= last_row))
+            tile = ((first_row + dr) * columns
+                    + first_column + dc)[overlaps].astype(np.int64)
+            selected = circles[overlaps]
+            order = np.argsort(tile, kind='stable')
+            tile = tile[order]
+            selected = selected[order]
+            ids, starts = np.unique(tile, return_index=True)
+            for tile_id, group in zip(ids, np.split(selected, starts[1:])):
+                path = os.path.join(tiles_dir, '{}.bin'.format(tile_id))
+                with open(path, 'ab') as tile_file:
+                    group.tofile(tile_file)
+
+def render_tiles(input_file, output_file, tiles, tile_size, dpi, text,
+                 min_pixels, label_pixels):
+    """Render the layout of input_file as a grid of PNG tiles.
+
+    The longer side of the layout is split in tiles tiles of tile_size
+    pixels. We read input_file twice: first to find its bounds, then to
+    sort its circles into a temporary file per tile, so that we only
+    need the circles of one tile in memory at a time. Circles smaller
+    than min_pixels across are left out, as are the numbers of circles
+    with radius less than label_pixels.
+    """
+    min_x, min_y, max_x, max_y = read_bounds(input_file)
+    min_x, min_y, max_x, max_y = min_x - 1, min_y - 1, max_x + 1, max_y + 1
+    tile_width = max(max_x - min_x, max_y - min_y) / tiles
+    columns = max(math.ceil((max_x - min_x) / tile_width), 1)
+    rows = max(math.ceil((max_y - min_y) / tile_width), 1)
+    pixel_width = tile_width / tile_size
+    stem, extension = os.path.splitext(output_file)
+    segments = [np.empty((0, 4))]
+    with tempfile.TemporaryDirectory() as tiles_dir:
+        number = 0
+        for circles, chunk_segments in iter_layout(input_file):
+            segments.append(chunk_segments)
+            numbers = np.arange(number + 1, number + len(circles) + 1)
+            number += len(circles)
+            visible = 2 * circles[:, 2] >= min_pixels * pixel_width
+            bucket_circles(np.column_stack((circles, numbers))[visible],
+                           tiles_dir, min_x, min_y, tile_width,
+                           rows, columns)
+        segments = np.concatenate(segments)
+        for row in range(rows):
+            for column in range(columns):
+                x0 = min_x + column * tile_width
+                y0 = min_y + row * tile_width
+                fig = plt.figure(figsize=(tile_size / dpi, tile_size / dpi),
+                                 dpi=dpi)
+                ax = fig.add_axes([0, 0, 1, 1])
+                ax.set_xlim(x0, x0 + tile_width)
+                ax.set_ylim(y0, y0 + tile_width)
+                ax.axis('off')
+                inside = ((np.minimum(segments[:, 0], segments[:, 2])
+                           <= x0 + tile_width)
+                          & (np.maximum(segments[:, 0], segments[:, 2]) >= x0)
+                          & (np.minimum(segments[:, 1], segments[:, 3])
+                             <= y0 + tile_width)
+                          & (np.maximum(segments[:, 1], segments[:, 3]) >= y0))
+                ax.add_collection(segment_collection(segments[inside]))
+                path = os.path.join(tiles_dir, '{}.bin'.format(
+                    row * columns + column))
+                if os.path.exists(path):
+                    circles = np.fromfile(path).reshape(-1, 4)
+                    ax.add_collection(circle_collection(circles,
+                                                        ax.transData))
+                    if text:
+                        labelled = circles[:, 2] >= label_pixels * pixel_width
+                        for x, y, _, n in circles[labelled]:
+                            ax.text(x, y, str(int(n)), clip_on=True)
+                # Rows are numbered from the top, as in images.
+                fig.savefig('{}_{}_{}{}'.format(stem, rows - 1 - row, column,
+                                                extension or '.png'),
+                            dpi=dpi)
+                plt.close(fig)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--text", action="store_true",
                     help="display circle numbers")
+parser.add_argument("-b", "--batch", action="store_true",
+                    help="do not display the figure; render with Agg")
+parser.add_argument("--tiles", type=int,
+                    help="render PNG tiles, this many along the longer "
+                    "side, named after output_file with their row and "
+                    "column; implies --batch")
+parser.add_argument("--tile_size", type=int, default=1024,
+                    help="tile width and height in pixels")
+parser.add_argument("--min_pixels", type=float, default=1,
+                    help="smallest circle diameter drawn in tiles, "
+                    "in pixels")
+parser.add_argument("--label_pixels", type=float, default=10,
+                    help="smallest circle radius labelled in tiles, "
+                    "in pixels")
 parser.add_argument("input_file", help="input file")
 parser.add_argument("output_file", help="output_file")
 args = parser.parse_args()
 
-min_x = sys.maxsize
-max_x = -sys.maxsize
-min_y = sys.maxsize
-max_y = -sys.maxsize
-
-circles = []
-texts = []
-segments = []
-
-with open(args.input_file) as input_file:
-    for line in input_file:
-        parts = [ float (x) for x in line.split() ]
-        if len(parts) == 3: # circle
-            min_x = min(min_x, parts[0]-parts[2])
-            min_y = min(min_y, parts[1]-parts[2])
-            max_x = max(max_x, parts[0]+parts[2])
-            max_y = max(max_y, parts[1]+parts[2])            
-            circles.append(Circle(parts[:2], parts[2],
-                                  edgecolor='black', facecolor='none',
-                                  linewidth=1))
-            if args.text:
-                texts.append((*parts[:2], len(circles)))
-        elif len(parts) == 4: # segment
-            min_x = min([min_x, *parts[::2]])
-            min_y = min(min_y, *parts[1::2])
-            max_x = max([max_x, *parts[::2]])
-            max_y = max(max_y, *parts[1::2])            
-            segments.append((parts[:2], parts[2:]))
-
-fig, ax = plt.subplots()
-ax.set_xlim(min_x - 1, max_x + 1)
-ax.set_ylim(min_y - 1, max_y + 1)
-sc = mc.LineCollection(segments, colors='black', linewidths=1)
-sc.set_capstyle('round')
-ax.add_collection(sc)
-cc = mc.PatchCollection(circles, match_original=True)
-ax.add_collection(cc)
-for text in texts:
-    ax.text(text[0], text[1], str(text[-1]))
-ax.set_aspect('equal')
-ax.axis('off')
-plt.tight_layout()
-if args.output_file:
-    plt.savefig(args.output_file, dpi=300)
-plt.show()
+if args.batch or args.tiles:
+    plt.switch_backend('Agg')
+
+if args.tiles:
+    render_tiles(args.input_file, args.output_file, args.tiles,
+                 args.tile_size, 100, args.text, args.min_pixels,
+                 args.label_pixels)
+else:
+    circles, segments = read_layout(args.input_file)
+    min_x, min_y, max_x, max_y = layout_bounds(circles, segments)
+
+    fig, ax = plt.subplots()
+    ax.set_xlim(min_x - 1, max_x + 1)
+    ax.set_ylim(min_y - 1, max_y + 1)
+    ax.add_collection(segment_collection(segments))
+    ax.add_collection(circle_collection(circles, ax.transData))
+    if args.text:
+        for i, (x, y, _) in enumerate(circles):
+            ax.text(x, y, str(i + 1))
+    ax.set_aspect('equal')
+    ax.axis('off')
+    plt.tight_layout()
+    if args.output_file:
+        plt.savefig(args.output_file, dpi=300)
+    if not args.batch:
+        plt.show()
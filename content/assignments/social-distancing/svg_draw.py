@@ -1,53 +1,93 @@
 import svgwrite
-import sys
 import argparse
+import gzip
+
+from layout_io import iter_layout, read_bounds, read_layout, layout_bounds
+
+SVG_HEADER = """<?xml version="1.0" encoding="utf-8" ?>
+<svg height="100%" version="1.1" width="100%" \
+xmlns="http://www.w3.org/2000/svg">
+<style>
+.c {{ fill: none; stroke: black; stroke-width: 1; }}
+.t {{ font-size: 5px; }}
+</style>
+<g transform="translate({},{})">
+"""
+
+SVG_FOOTER = """</g>
+</svg>
+"""
+
+def stream_svg(input_file, output_file, text, compress):
+    """Write the layout of input_file as SVG, without keeping it in memory.
+
+    We read input_file twice: first to find its bounds, then to write
+    its circles and segments a chunk at a time. All elements share the
+    style of their class, instead of carrying their own attributes.
+    """
+    min_x, min_y, _, _ = read_bounds(input_file)
+    if compress:
+        svg_file = gzip.open(output_file, 'wt', encoding='utf-8',
+                             compresslevel=6)
+    else:
+        svg_file = open(output_file, 'w', encoding='utf-8')
+    with svg_file:
+        svg_file.write(SVG_HEADER.format(-min_x + OFFSET, -min_y + OFFSET))
+        number = 0
+        for circles, segments in iter_layout(input_file):
+            for x, y, r in circles.tolist():
+                number += 1
+                svg_file.write(
+                    '<circle class="c" cx="{}" cy="{}" r="{}" />\n'.format(
+                        x, -y, r))
+                if text:
+                    svg_file.write(
+                        '<text class="t" x="{}" y="{}">{}</text>\n'.format(
+                            x, -y, number))
+            for x1, y1, x2, y2 in segments.tolist():
+                svg_file.write(
+                    '<line class="c" x1="{}" y1="{}" x2="{}" y2="{}" />\n'
+                    .format(x1, y1, x2, y2))
+        svg_file.write(SVG_FOOTER)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--text", action="store_true",
                     help="display circle numbers")
+parser.add_argument("-s", "--stream", action="store_true",
+                    help="write the elements as they are read, "
+                    "for very large layouts")
+parser.add_argument("-z", "--gzip", action="store_true",
+                    help="compress the streamed output; "
+                    "implied if output_file ends in .svgz")
 parser.add_argument("input_file", help="input file")
 parser.add_argument("output_file", help="output_file")
 args = parser.parse_args()
 
-
 OFFSET = 50
-dwg = svgwrite.Drawing(args.output_file, profile='tiny')
-
-min_x = sys.maxsize
-max_x = -sys.maxsize
-min_y = sys.maxsize
-max_y = -sys.maxsize
-
-circles = []
-segments = []
-
-with open(args.input_file) as input_file:
-    for line in input_file:
-        parts = [ float (x) for x in line.split() ]
-        if len(parts) == 3: # circle
-            min_x = min(min_x, parts[0]-parts[2])
-            min_y = min(min_y, parts[1]-parts[2])
-            circles.append(parts)
-        elif len(parts) == 4: # segment
-            min_x = min([min_x, *parts[::2]])
-            min_y = min(min_y, *parts[1::2])
-            segments.append((parts[:2], parts[2:]))
-            
-svg_group = dwg.g()
-svg_group.translate(-min_x+OFFSET, -min_y+OFFSET)
-dwg.add(svg_group)
-
-for i, c in enumerate(circles):
-    svg_group.add(dwg.circle((c[0], -c[1]), c[2],
-                             stroke='black', stroke_width=1, fill="none"))
-    if args.text:
-        text_group = dwg.g(font_size=5)
-        text_group.add(dwg.text(i+1, insert=(c[0], -c[1])))
-        svg_group.add(text_group)    
-
-for segment in segments:
-    p1, p2 = segment    
-    svg_group.add(dwg.line((p1[0], p1[1]), (p2[0], p2[1]),
-                           stroke='black', stroke_width=1))    
-    
-dwg.save()
+compress = args.gzip or args.output_file.endswith('.svgz')
+if args.stream or compress:
+    stream_svg(args.input_file, args.output_file, args.text, compress)
+else:
+    dwg = svgwrite.Drawing(args.output_file, profile='tiny')
+
+    circles, segments = read_layout(args.input_file)
+    min_x, min_y, _, _ = layout_bounds(circles, segments)
+
+    svg_group = dwg.g()
+    svg_group.translate(-min_x+OFFSET, -min_y+OFFSET)
+    dwg.add(svg_group)
+
+    for i, c in enumerate(circles):
+        svg_group.add(dwg.circle((c[0], -c[1]), c[2],
+                                 stroke='black', stroke_width=1, fill="none"))
+        if args.text:
+            text_group = dwg.g(font_size=5)
+            text_group.add(dwg.text(i+1, insert=(c[0], -c[1])))
+            svg_group.add(text_group)    
+
+    for segment in segments:
+        x1, y1, x2, y2 = segment
+        svg_group.add(dwg.line((x1, y1), (x2, y2),
+                               stroke='black', stroke_width=1))    
+
+    dwg.save()
@@ -0,0 +1,178 @@
+import argparse
+import math
+import random
+import sys
+import time
+
+def read_layout(filenames):
+    """Read the circles and the segments of the layout files.
+
+    Returns
+    -------
+    circles, segments : list, list
+        The circles, as (x, y, r) tuples, and the segments, as
+        (x1, y1, x2, y2) tuples
+    """
+    circles = []
+    segments = []
+    for filename in filenames:
+        with open(filename) as input_file:
+            for line in input_file:
+                parts = [ float(x) for x in line.split() ]
+                if len(parts) == 3: # circle
+                    circles.append(tuple(parts))
+                elif len(parts) == 4: # segment
+                    segments.append(tuple(parts))
+    return circles, segments
+
+def segment_distance(x, y, segment):
+    """Return the distance of point (x, y) from segment."""
+    ux, uy, vx, vy = segment
+    l2 = (ux - vx)**2 + (uy - vy)**2
+    if l2 == 0:
+        return math.hypot(ux - x, uy - y)
+    t = ((x - ux) * (vx - ux) + (y - uy) * (vy - uy)) / l2
+    t = max(0, min(1, t))
+    return math.hypot(ux + t * (vx - ux) - x, uy + t * (vy - uy) - y)
+
+def build_grid(circles, segments, cell_size):
+    """Index the circles and the segments in a uniform grid.
+
+    Each circle goes to the cell of its center. Each segment goes to the
+    cells of points sampled along it, every half cell, so that any point
+    of the segment is within a quarter cell of a sample.
+
+    Returns
+    -------
+    circle_cells, segment_cells : dict, dict
+        Map each cell, as a pair of integers, to the indices of the
+        circles, or the segments, in it
+    """
+    circle_cells = {}
+    for i, (x, y, _) in enumerate(circles):
+        cell = (math.floor(x / cell_size), math.floor(y / cell_size))
+        circle_cells.setdefault(cell, []).append(i)
+    segment_cells = {}
+    for i, (ux, uy, vx, vy) in enumerate(segments):
+        samples = math.ceil(math.hypot(vx - ux, vy - uy) / (cell_size / 2))
+        cells = set()
+        for k in range(samples + 1):
+            t = k / samples if samples > 0 else 0
+            cells.add((math.floor((ux + t * (vx - ux)) / cell_size),
+                       math.floor((uy + t * (vy - uy)) / cell_size)))
+        for cell in cells:
+            segment_cells.setdefault(cell, []).append(i)
+    return circle_cells, segment_cells
+
+def find_violations(circles, segments, tolerance=0.01):
+    """Find the circles that overlap other circles or cross segments.
+
+    Tangent circles, and circles tangent to segments, are valid. As
+    coordinates are rounded to two decimal places, a tangent circle can
+    be up to about 0.007 closer than it should be, so we only report
+    circles that overlap by more than tolerance.
+
+    We index the circles and the segments in a uniform grid with cells
+    twice the largest radius, so a circle can only overlap circles, or
+    cross segments, in its own cell and the eight cells around it.
+
+    Returns
+    -------
+    violations : list
+        The violating pairs, as tuples ('circle', i, j) or
+        ('segment', i, j), where i is the index of a circle and j the
+        index of a circle or a segment, counting from 1
+    """
+    violations = []
+    if len(circles) == 0:
+        return violations
+    max_r = max(r for (_, _, r) in circles)
+    cell_size = 2 * max_r if max_r > 0 else 1
+    circle_cells, segment_cells = build_grid(circles, segments, cell_size)
+    neighbors = [ (dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) ]
+    for i, (x, y, r) in enumerate(circles):
+        cx = math.floor(x / cell_size)
+        cy = math.floor(y / cell_size)
+        for dx, dy in neighbors:
+            cell = (cx + dx, cy + dy)
+            for j in circle_cells.get(cell, ()):
+                if j <= i:
+                    continue
+                ox, oy, o_r = circles[j]
+                if math.hypot(ox - x, oy - y) < r + o_r - tolerance:
+                    violations.append(('circle', i + 1, j + 1))
+        crossed = set()
+        for dx, dy in neighbors:
+            for j in segment_cells.get((cx + dx, cy + dy), ()):
+                if j in crossed:
+                    continue
+                if segment_distance(x, y, segments[j]) < r - tolerance:
+                    crossed.add(j)
+        violations.extend(('segment', i + 1, j + 1) for j in sorted(crossed))
+    violations.sort()
+    return violations
+
+def hex_layout(n, radius, jitter, seed):
+    """Return n circles on a hexagonal lattice of tangent circles.
+
+    With jitter the radii are picked at random between radius * (1 -
+    jitter) and radius, so the layout stays valid. The lattice is
+    enclosed in a rectangle of four segments.
+    """
+    random.seed(seed)
+    columns = math.ceil(math.sqrt(n))
+    dy = round(radius * math.sqrt(3), 2)
+    circles = []
+    for i in range(n):
+        row, column = divmod(i, columns)
+        x = 2 * radius * column + (radius if row % 2 else 0)
+        r = radius * (1 - jitter * random.random())
+        circles.append((x, row * dy, round(r, 2)))
+    max_x = 2 * radius * columns + radius
+    max_y = dy * (n // columns) + radius
+    min_x = min_y = -radius
+    segments = [(min_x, min_y, max_x, min_y), (max_x, min_y, max_x, max_y),
+                (max_x, max_y, min_x, max_y), (min_x, max_y, min_x, min_y)]
+    return circles, segments
+
+def benchmark(sizes, seed):
+    print('{:>10} {:>10} {:>12}'.format('circles', 'violations', 'seconds'))
+    for size in sizes:
+        circles, segments = hex_layout(size, 10, 0.2, seed)
+        # Move some circles, so that there is something to find.
+        for k in range(0, size, 1000):
+            x, y, r = circles[k]
+            circles[k] = (x + r / 2, y, r)
+        start = time.perf_counter()
+        violations = find_violations(circles, segments)
+        elapsed = time.perf_counter() - start
+        print('{:>10} {:>10} {:>12.3f}'.format(size, len(violations),
+                                               elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+                                     'Check a layout of circles and segments')
+    parser.add_argument("input_files", nargs='*',
+                        help="input files; circles and segments may be "
+                        "in different files")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.01,
+                        help="largest overlap allowed, for rounding errors")
+    parser.add_argument("-b", "--benchmark", nargs='+', type=int,
+                        help="instead of checking files, time the check "
+                        "on synthetic layouts of these many circles")
+    parser.add_argument("-s", "--seed", type=int, default=42,
+                        help="random seed for the benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.seed)
+        sys.exit(0)
+    if not args.input_files:
+        parser.error('no input files')
+    circles, segments = read_layout(args.input_files)
+    violations = find_violations(circles, segments, args.tolerance)
+    for kind, i, j in violations:
+        print('circle {} intersects {} {}'.format(i, kind, j))
+    print('{} circles, {} segments, {} violations'.format(
+        len(circles), len(segments), len(violations)), file=sys.stderr)
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,171 @@
+import argparse
+import filecmp
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+NOTEBOOKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CORPORA = [
+    os.path.join(NOTEBOOKS_DIR, 'ulysses.txt'),
+    os.path.join(NOTEBOOKS_DIR, '..', 'assignments', 'a-kilo-of-data',
+                 '1984.txt'),
+]
+
+# Each measurement runs in a new interpreter, so that the peak resident
+# set size we get is that of a single compression or decompression.
+MEASURE = """
+import json, resource, sys, time
+sys.path.insert(0, {directory!r})
+from {module} import {function}
+start = time.perf_counter()
+{function}(*{args!r})
+elapsed = time.perf_counter() - start
+# ru_maxrss is in kilobytes on Linux.
+print(json.dumps({{'seconds': elapsed,
+                  'peak_rss_kb': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+def measure(module, function, *args):
+    """Call function of module with args in a new interpreter.
+
+    Returns a dictionary with the seconds the call took and the peak
+    resident set size of the interpreter, in kilobytes.
+    """
+    code = MEASURE.format(directory=NOTEBOOKS_DIR, module=module,
+                          function=function, args=args)
+    result = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True)
+    return json.loads(result.stdout)
+
+def benchmarked_codecs(nbs):
+    """Return the codecs to benchmark, with the module and the functions
+    for compression and decompression, and any extra arguments.
+    """
+    codecs = {
+        'huffman': ('huffman', 'huffman_compress', 'huffman_decompress', ()),
+    }
+    for nb in nbs:
+        codecs['lzw-{}'.format(nb)] = ('lzw', 'lzw_compress',
+                                       'lzw_decompress', (nb, 2**8))
+    return codecs
+
+def create_synthetic(source, output_file, size, seed):
+    """Write about size bytes of text to output_file, made of lines of
+    source picked at random, without keeping the output in memory.
+    """
+    random.seed(seed)
+    with open(source) as source_file:
+        lines = source_file.readlines()
+    written = 0
+    with open(output_file, 'w') as synthetic_file:
+        while written < size:
+            block = ''.join(random.choices(lines, k=10000))
+            synthetic_file.write(block)
+            written += len(block)
+
+def benchmark(corpora, nbs, tmp_dir):
+    results = []
+    for corpus in corpora:
+        size = os.path.getsize(corpus)
+        for name, codec in benchmarked_codecs(nbs).items():
+            module, compress, decompress, extra = codec
+            compressed = os.path.join(tmp_dir, 'compressed')
+            decompressed = os.path.join(tmp_dir, 'decompressed')
+            compression = measure(module, compress, corpus, compressed,
+                                  *extra)
+            decompression = measure(module, decompress, compressed,
+                                    decompressed, *extra)
+            result = {
+                'corpus': os.path.basename(corpus),
+                'codec': name,
+                'size': size,
+                'ratio': size / max(os.path.getsize(compressed), 1),
+                'compress_mb_s': size / 2**20 / compression['seconds'],
+                'decompress_mb_s': size / 2**20 / decompression['seconds'],
+                'compress_peak_rss_kb': compression['peak_rss_kb'],
+                'decompress_peak_rss_kb': decompression['peak_rss_kb'],
+                'round_trip': filecmp.cmp(corpus, decompressed, shallow=False),
+            }
+            print('{corpus:>20} {codec:>8} ratio {ratio:5.2f} '
+                  'compress {compress_mb_s:6.2f} MB/s '
+                  'decompress {decompress_mb_s:6.2f} MB/s '
+                  'round trip {round_trip}'.format(**result),
+                  file=sys.stderr)
+            results.append(result)
+    return results
+
+def find_regressions(results, baseline, threshold):
+    """Compare results with baseline results and return a description of
+    each run whose round trip failed or whose throughput dropped by more
+    than threshold, as a fraction of the baseline throughput.
+    """
+    previous = { (result['corpus'], result['codec']): result
+                 for result in baseline }
+    regressions = []
+    for result in results:
+        if not result['round_trip']:
+            regressions.append('{corpus} {codec}: round trip failed'.format(
+                **result))
+        key = (result['corpus'], result['codec'])
+        if key not in previous:
+            continue
+        for metric in ['compress_mb_s', 'decompress_mb_s']:
+            if result[metric] < (1 - threshold) * previous[key][metric]:
+                regressions.append(
+                    '{} {}: {} dropped from {:.2f} to {:.2f}'.format(
+                        *key, metric, previous[key][metric], result[metric]))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+                                     'Benchmark huffman.py and lzw.py')
+
+    parser.add_argument('corpora', nargs='*', help='input files',
+                        default=CORPORA)
+    parser.add_argument('-n', '--nb', nargs='+',
+                        help='maximum numbers of bits for LZW',
+                        type=int, default=[12, 16, 20])
+    parser.add_argument('-s', '--synthetic', nargs='+', type=int, default=[],
+                        help='also benchmark synthetic text of these '
+                        'many MB, made from the first input file')
+    parser.add_argument('--seed', help='random seed for synthetic text',
+                        type=int, default=42)
+    parser.add_argument('-o', '--output', help='JSON file for the results')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON file with earlier results to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='largest allowed drop in throughput, '
+                        'as a fraction of the baseline')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpora = list(args.corpora)
+        for size in args.synthetic:
+            synthetic = os.path.join(tmp_dir,
+                                     'synthetic_{}mb.txt'.format(size))
+            create_synthetic(args.corpora[0], synthetic, size * 2**20,
+                             args.seed)
+            corpora.append(synthetic)
+        results = benchmark(corpora, args.nb, tmp_dir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    baseline = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = find_regressions(results, baseline, args.threshold)
+    for regression in regressions:
+        print(regression, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -1,7 +1,58 @@
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
+import bisect
+import codecs
+import csv
+import functools
+import io
+import itertools
+import locale
+import mmap
+import os
 import pickle
 import argparse
+import struct
+import sys
+
+# The compressed file starts with a header identifying the format and
+# giving the number of encoded characters and the number of distinct
+# characters. Then, for each distinct character, it contains its
+# Unicode code point and the length of its code. The codes themselves
+# are canonical, so they can be reconstructed from their lengths.
+MAGIC = b'HUF1'
+HEADER = struct.Struct('>4sQI')
+SYMBOL_ENTRY = struct.Struct('>IB')
+
+# The maximum length of a code; the header keeps lengths in a byte.
+MAX_CODE_LENGTH = 32
+
+# The decoder looks up this many bits at a time.
+LOOKUP_BITS = 12
+
+# In block mode, the file starts with BLOCK_MAGIC, followed by blocks
+# that are each compressed like a whole file, with their own header.
+# After the blocks there is an index with the offset, the compressed
+# size and the number of characters of each block. The file ends with
+# the offset of the index, the number of blocks, and BLOCK_MAGIC again.
+BLOCK_MAGIC = b'HUFB'
+BLOCK_ENTRY = struct.Struct('>QQQ')
+BLOCK_TRAILER = struct.Struct('>QQ4s')
+
+# Number of characters in each block.
+BLOCK_SIZE = 2**22
+
+# Adaptive Huffman streams start with ADAPTIVE_MAGIC. They encode bytes,
+# plus EOF_SYMBOL, which marks the end of the stream. A symbol that we
+# have not seen before is sent after the code of the NYT (not yet
+# transmitted) node, in SYMBOL_BITS bits.
+ADAPTIVE_MAGIC = b'HUFA'
+EOF_SYMBOL = 256
+SYMBOL_BITS = 9
+
+# Size of the chunks we read from the compressed file and the number of
+# decoded pieces we keep before writing them out.
+CHUNK_SIZE = 2**20
 
 def create_pq():
     return []
@@ -79,103 +130,856 @@ def create_huffman_code(pq):
         insert_in_pq(pq, [x[0] + y[0]] + x[1:] + y[1:])
     return extract_min_from_pq(pq)
 
-def huffman_compress(input_file, output_file):
-    pq = create_pq()
-    # First pass: count character occurrences.
+def canonical_code(code_lengths):
+    """Assign canonical Huffman codes to symbols from their code lengths.
+
+    Symbols are sorted by code length and then by value; each symbol
+    gets the next code of the given length, so that the codes can be
+    reconstructed from the lengths alone. Returns a dictionary that
+    maps each symbol to a (code, length) pair.
+    """
+    codes = {}
+    code = 0
+    prev_length = 0
+    for symbol, length in sorted(code_lengths.items(),
+                                 key=lambda x: (x[1], x[0])):
+        code <<= length - prev_length
+        codes[symbol] = (code, length)
+        code += 1
+        prev_length = length
+    return codes
+
+def write_header(compressed_file, code_lengths, num_chars):
+    compressed_file.write(HEADER.pack(MAGIC, num_chars, len(code_lengths)))
+    for character, length in code_lengths.items():
+        compressed_file.write(SYMBOL_ENTRY.pack(ord(character), length))
+
+def read_header(compressed_file):
+    """Read the header of a canonical Huffman file.
+
+    Returns the code lengths of the characters and the number of
+    encoded characters, or None if the file does not start with the
+    canonical Huffman header.
+    """
+    header = compressed_file.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        return None
+    _, num_chars, num_symbols = HEADER.unpack(header)
+    entries = compressed_file.read(num_symbols * SYMBOL_ENTRY.size)
+    code_lengths = { chr(code_point): length for (code_point, length)
+                     in SYMBOL_ENTRY.iter_unpack(entries) }
+    return code_lengths, num_chars
+
+def create_decoding_table(codes, lookup_bits=LOOKUP_BITS):
+    """Create a table for decoding lookup_bits bits at a time.
+
+    The table is indexed by all lookup_bits-bit values. Each entry holds
+    the characters whose codes appear, one after the other, at the start
+    of the index, and the number of bits these codes take up. An entry
+    whose first code is longer than lookup_bits bits holds no characters
+    and zero bits; such codes are decoded by decode_long_code.
+    """
+    # First find, for each index, the single code it starts with.
+    single = [None] * (1 << lookup_bits)
+    for character, (code, length) in codes.items():
+        if length <= lookup_bits:
+            start = code << (lookup_bits - length)
+            for i in range(start, start + (1 << (lookup_bits - length))):
+                single[i] = (character, length)
+    # Then keep decoding codes from each index, as long as they fit
+    # in its bits.
+    mask = (1 << lookup_bits) - 1
+    table = []
+    for index in range(1 << lookup_bits):
+        characters = ''
+        used = 0
+        while used < lookup_bits:
+            entry = single[(index << used) & mask]
+            if entry is None or entry[1] > lookup_bits - used:
+                break
+            characters += entry[0]
+            used += entry[1]
+        table.append((characters, used))
+    return table
+
+def create_long_code_table(codes):
+    """Create the tables for decoding canonical codes length by length.
+
+    For each length, we keep the first code of that length, the number
+    of codes with that length, and the characters having them, in code
+    order.
+    """
+    first_code = {}
+    characters = {}
+    for character, (code, length) in sorted(codes.items(),
+                                            key=lambda x: x[1]):
+        first_code.setdefault(length, code)
+        characters.setdefault(length, []).append(character)
+    return first_code, characters
+
+def decode_long_code(acc, nbits, long_code_table, lookup_bits):
+    """Decode a code longer than lookup_bits from the top of acc.
+
+    Returns the character and the length of its code.
+    """
+    first_code, characters = long_code_table
+    for length in sorted(first_code):
+        if length <= lookup_bits or length > nbits:
+            continue
+        code = (acc >> (nbits - length)) & ((1 << length) - 1)
+        offset = code - first_code[length]
+        if 0 <= offset < len(characters[length]):
+            return characters[length][offset], length
+    raise ValueError('invalid Huffman code in compressed file')
+
+def huffman_code_lengths(symb2freq, max_length=MAX_CODE_LENGTH):
+    """Return the length of the Huffman code of each symbol.
+
+    Instead of a priority queue of nodes, we sort the symbols by
+    frequency and keep the tree in parallel arrays: the frequency and
+    the parent of each node, with the symbols first and the internal
+    nodes following in the order we create them. As the internal nodes
+    are created with non-decreasing frequencies, the two smallest nodes
+    are always at the front of either the symbols or the internal nodes
+    not yet merged. The depth of each node is then found in one pass
+    from the root down. If some code is longer than max_length, we find
+    the optimal code lengths that respect the limit with package_merge
+    instead.
+    """
+    if len(symb2freq) == 0:
+        return {}
+    # A file with a single distinct symbol still needs one bit
+    # per symbol.
+    if len(symb2freq) == 1:
+        return { symbol: 1 for symbol in symb2freq }
+    symbols = sorted(symb2freq, key=symb2freq.__getitem__)
+    n = len(symbols)
+    freq = [ symb2freq[symbol] for symbol in symbols ] + [0] * (n - 1)
+    parent = [0] * (2 * n - 1)
+    next_symbol = 0
+    next_internal = n
+    for node in range(n, 2 * n - 1):
+        for _ in range(2):
+            if (next_symbol < n and
+                (next_internal == node
+                 or freq[next_symbol] <= freq[next_internal])):
+                child = next_symbol
+                next_symbol += 1
+            else:
+                child = next_internal
+                next_internal += 1
+            freq[node] += freq[child]
+            parent[child] = node
+    # The root is the last node; every other node is one level below
+    # its parent, which was created after it.
+    depth = [0] * (2 * n - 1)
+    for node in range(2 * n - 3, -1, -1):
+        depth[node] = depth[parent[node]] + 1
+    if max(depth[:n]) > max_length:
+        return package_merge(symb2freq, max_length)
+    return dict(zip(symbols, depth))
+
+def package_merge(symb2freq, max_length):
+    """Return optimal code lengths that are at most max_length.
+
+    The package-merge algorithm goes through max_length levels. At each
+    level, it merges the symbols, sorted by frequency, with the packages
+    formed by pairing the items of the previous level. The code length
+    of a symbol is the number of times it appears in the first 2n - 2
+    items of the last level, when we expand packages to their items.
+    As the items we take from each level are always a prefix, we only
+    need to remember which items of each level are symbols.
+    """
+    symbols = sorted(symb2freq, key=lambda symbol: symb2freq[symbol])
+    if len(symbols) > 2**max_length:
+        raise ValueError('cannot encode {} symbols in {} bits'.format(
+            len(symbols), max_length))
+    if len(symbols) == 1:
+        return { symbols[0]: 1 }
+    weights = [ symb2freq[symbol] for symbol in symbols ]
+    levels = []
+    packages = []
+    for _ in range(max_length):
+        # Both lists are sorted, so sorting them together merges them.
+        merged = sorted([ (weight, 1) for weight in weights ] +
+                        [ (weight, 0) for weight in packages ])
+        levels.append(bytes(is_symbol for (_, is_symbol) in merged))
+        packages = [ merged[i][0] + merged[i + 1][0]
+                     for i in range(0, len(merged) - 1, 2) ]
+    lengths = [0] * len(symbols)
+    selected = 2 * len(symbols) - 2
+    for is_symbol in reversed(levels):
+        num_symbols = is_symbol.count(1, 0, selected)
+        for i in range(num_symbols):
+            lengths[i] += 1
+        selected = 2 * (selected - num_symbols)
+    return dict(zip(symbols, lengths))
+
+def count_characters(input_file):
+    """Count the occurrences of each character in input_file.
+
+    We map the file in memory and decode it in blocks of CHUNK_SIZE
+    bytes, translating newlines as when reading a file in text mode.
+    Each decoded block is counted with a single Counter.update call.
+    """
     symb2freq = Counter()
-    with open(input_file) as uncompressed_file:
-        for line in uncompressed_file:
-            symb2freq += Counter(line)
-    # Put the occurrences in a priority queue.
-    pq = create_pq()
-    for key, value in symb2freq.items():
-        insert_in_pq(pq, [value, [key, '']])
-    # Create the Huffman code.
-    hc = create_huffman_code(pq)
-    # Turn the code to a dictionary for easier lookup.
-    hc_table = { character: encoding for [character, encoding] in  hc[1:]}
+    with open(input_file, 'rb') as uncompressed_file:
+        size = os.fstat(uncompressed_file.fileno()).st_size
+        # An empty file cannot be mapped in memory.
+        if size == 0:
+            return symb2freq
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+            translate=True)
+        with mmap.mmap(uncompressed_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as mapped_file:
+            for start in range(0, size, CHUNK_SIZE):
+                symb2freq.update(
+                    decoder.decode(mapped_file[start:start + CHUNK_SIZE]))
+        symb2freq.update(decoder.decode(b'', final=True))
+    return symb2freq
+
+def read_code_table(table_file):
+    """Read a code table from a CSV file, with a character and its code
+    in each row, and return the code length of each character.
+
+    Only the lengths matter, as we use the canonical code with the same
+    lengths; they must be possible for a prefix code.
+    """
+    code_lengths = {}
+    with open(table_file, newline='') as csv_file:
+        for character, code in csv.reader(csv_file):
+            if len(code) == 0 or code.strip('01'):
+                raise ValueError('invalid binary code {!r} for {!r}'.format(
+                    code, character))
+            code_lengths[character] = len(code)
+    if sum(2**-length for length in code_lengths.values()) > 1:
+        raise ValueError('the codes in {} are not a prefix code'.format(
+            table_file))
+    return code_lengths
+
+def write_code_table(table_file, code_lengths):
+    """Write the canonical code for code_lengths to a CSV file."""
+    with open(table_file, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        for character, (code, length) in canonical_code(code_lengths).items():
+            writer.writerow([character, format(code, '0{}b'.format(length))])
+
+def huffman_compress(input_file, output_file, code_lengths=None,
+                     table_file=None):
+    """Compress input_file to output_file.
+
+    If code_lengths is given, we use it as a static code and skip
+    counting the characters; otherwise we count them in a first pass
+    and create the Huffman code. If table_file is given, we save the
+    code we used in it, so that we can use it again with read_code_table.
+    If a character has no code, we remove output_file and raise
+    ValueError.
+    """
+    if code_lengths is None:
+        # First pass: count character occurrences.
+        symb2freq = count_characters(input_file)
+        # Create the Huffman code; we only keep the length of each
+        # encoding, and derive the canonical code from them.
+        code_lengths = huffman_code_lengths(symb2freq)
+    if table_file is not None:
+        write_code_table(table_file, code_lengths)
     # Second pass: we'll read again the uncompressed file,
     # we'll compress the contents and save them to the
     # compressed file as we go.
-    with open(input_file) as uncompressed_file, \
-        open(output_file, 'wb') as compressed_file:
-        # First save the Huffman encoding.
-        pickle.dump(hc_table, compressed_file)
-        # Then save the total number of characters in the input file.
-        pickle.dump(sum(symb2freq.values()), compressed_file)
-        # Use a buffer in which we will be adding the encoded characters;
-        # when the buffer has 8 bits or more we will output a byte and
-        # keep the remaining bits.
-        buffer = ''
-        for line in uncompressed_file:
-            for c in line:
-                # For each character, add the encoding to the buffer.
-                buffer += hc_table[c]
-                # Have we got enough stuff in the buffer to output a byte?
-                while len(buffer) >= 8:
-                    # Yes, output a byte
-                    byte = int(buffer[:8], base=2).to_bytes(1, byteorder='big')
-                    compressed_file.write(byte)
-                    # Keep any remaining stuff in the buffer; that will go out
-                    # with the next byte.
-                    buffer = buffer[8:]
-        if len(buffer) > 0:
-            # If we have still remaining stuff, it means that part of the last 
-            # character encoding was put in the previous byte, and part of it
-            # will go in the last byte; we'll pad zeroes to the end of it.
-            buffer = buffer.ljust(8, '0')
-            byte = int(buffer[:8], base=2).to_bytes(1, byteorder='big')
-            compressed_file.write(byte)
-
-def huffman_decompress(input_file, output_file):
+    try:
+        with open(input_file) as uncompressed_file, \
+            open(output_file, 'wb') as compressed_file:
+            # First save the header, with the code lengths; we do not
+            # know the number of characters if we did not count them, so
+            # we fill it in after compressing.
+            write_header(compressed_file, code_lengths, 0)
+            num_chars = compress_canonical(uncompressed_file, compressed_file,
+                                           canonical_code(code_lengths))
+            compressed_file.seek(0)
+            compressed_file.write(HEADER.pack(MAGIC, num_chars,
+                                              len(code_lengths)))
+    except ValueError:
+        # Do not leave a truncated file behind.
+        os.remove(output_file)
+        raise
+
+def compress_canonical(uncompressed_file, compressed_file, codes):
+    """Encode the contents of uncompressed_file to compressed_file.
+
+    We read the input in blocks of CHUNK_SIZE characters. The (code,
+    length) pair of each character is shifted into an integer
+    accumulator; whenever the accumulator has 64 bits or more we move
+    eight bytes to an output buffer, which is written out after each
+    block. So the memory we use does not depend on the size of the file.
+    Returns the number of characters we encoded.
+    """
+    acc = 0
+    nbits = 0
+    num_chars = 0
+    buffer = bytearray()
+    block = uncompressed_file.read(CHUNK_SIZE)
+    while block:
+        try:
+            for code, length in map(codes.__getitem__, block):
+                acc = (acc << length) | code
+                nbits += length
+                if nbits >= 64:
+                    nbits -= 64
+                    buffer += (acc >> nbits).to_bytes(8, byteorder='big')
+                    acc &= (1 << nbits) - 1
+        except KeyError as e:
+            raise ValueError('character {!r} has no code'.format(
+                e.args[0])) from None
+        num_chars += len(block)
+        compressed_file.write(buffer)
+        buffer.clear()
+        block = uncompressed_file.read(CHUNK_SIZE)
+    if nbits > 0:
+        # Pad the last bits with zeroes up to a whole byte.
+        num_bytes = (nbits + 7) // 8
+        acc <<= 8 * num_bytes - nbits
+        compressed_file.write(acc.to_bytes(num_bytes, byteorder='big'))
+    return num_chars
+
+def decompress_canonical(compressed_file, decompressed_file,
+                         code_lengths, num_chars, lookup_bits=LOOKUP_BITS):
+    """Decode num_chars characters from compressed_file.
+
+    The bits are kept in an integer accumulator; at each step we look up
+    the next lookup_bits bits in the decoding table, which gives us all
+    the characters whose codes fit in them.
+    """
+    codes = canonical_code(code_lengths)
+    table = create_decoding_table(codes, lookup_bits)
+    long_code_table = create_long_code_table(codes)
+    max_length = max((length for (_, length) in codes.values()), default=0)
+    # The number of bits we need in the accumulator before decoding.
+    needed = max(lookup_bits, max_length)
+    mask = (1 << lookup_bits) - 1
+    acc = 0
+    nbits = 0
+    num_decompressed = 0
+    pieces = []
+    data = compressed_file.read(CHUNK_SIZE)
+    pos = 0
+    while num_decompressed < num_chars:
+        if nbits < needed:
+            # Refill the accumulator; when the file is exhausted, we
+            # pad it with zeroes, which can only be decoded past the
+            # last character, and will be discarded.
+            if pos == len(data):
+                data = compressed_file.read(CHUNK_SIZE)
+                pos = 0
+            # Drop the bits we have already consumed.
+            acc &= (1 << nbits) - 1
+            if data:
+                more = data[pos:pos + 8]
+                pos += len(more)
+                acc = (acc << (8 * len(more))) | int.from_bytes(more,
+                                                                byteorder='big')
+                nbits += 8 * len(more)
+            else:
+                acc <<= needed
+                nbits += needed
+            continue
+        characters, used = table[(acc >> (nbits - lookup_bits)) & mask]
+        if used == 0:
+            characters, used = decode_long_code(acc, nbits, long_code_table,
+                                                lookup_bits)
+        # The last table entry may go past the last character, into
+        # the padding of the last byte; we drop what lies past it
+        # before it can be written out.
+        if num_decompressed + len(characters) > num_chars:
+            characters = characters[:num_chars - num_decompressed]
+        pieces.append(characters)
+        num_decompressed += len(characters)
+        nbits -= used
+        if len(pieces) >= CHUNK_SIZE // 64:
+            decompressed_file.write(''.join(pieces))
+            pieces = []
+    decompressed_file.write(''.join(pieces))
+
+def decompress_pickled(compressed_file, decompressed_file):
+    """Decompress a file with a pickled Huffman table.
+
+    This is the format written by earlier versions of huffman_compress.
+    """
+    # Read the Huffman table.
+    hc_table = pickle.load(compressed_file)
+    # Read the total number of uncompressed characters.
+    num_chars = pickle.load(compressed_file)
+    # Construct an inverse, Huffman decoding table.
+    hc_decoding_table = { v: k for (k, v) in hc_table.items() }
+    # Set a counter for the decompressed characters.
+    num_decompressed = 0
+    # Keep the Huffman code that we want to decode.
+    encoding = ''
+    # Read the file byte-by-byte.
+    byte = compressed_file.read(1)
+    while byte:
+        # For each byte, get its bit representation.
+        bit_repr = format(int.from_bytes(byte, byteorder='big'), '08b')
+        # Then read it bit-by-bit, extending the current encoding
+        # that we are trying to decode.
+        for bit in bit_repr:
+            encoding += bit
+            # Is this a valid Huffman encoding?
+            if encoding in hc_decoding_table:
+                # Yes, decompress it.
+                decompressed_file.write(hc_decoding_table[encoding])
+                num_decompressed += 1
+                # If we have decompressed the expected amount of
+                # characters, we are done; any leftover is just the
+                # padding of the last byte of the file.
+                if num_decompressed == num_chars:
+                    break
+                encoding = ''
+        byte = compressed_file.read(1)
+
+def huffman_decompress(input_file, output_file, workers=None):
+    with open(input_file, 'rb') as compressed_file:
+        magic = compressed_file.read(len(ADAPTIVE_MAGIC))
+    if magic == ADAPTIVE_MAGIC:
+        adaptive_huffman_decompress(input_file, output_file)
+        return
     with open(input_file, 'rb') as compressed_file,\
         open(output_file, 'w') as decompressed_file:
-        # Read the Huffman table.
-        hc_table = pickle.load(compressed_file)
-        # Read the total number of uncompressed characters.
-        num_chars = pickle.load(compressed_file)
-        # Construct an inverse, Huffman decoding table.
-        hc_decoding_table = { v: k for (k, v) in hc_table.items() }
-        # Set a counter for the decompressed characters.
-        num_decompressed = 0
-        # Keep the Huffman code that we want to decode.
-        encoding = ''
-        # Read the file byte-by-byte.
-        byte = compressed_file.read(1)
-        while byte:
-            # For each byte, get its bit representation.
-            bit_repr = format(int.from_bytes(byte, byteorder='big'), '08b')
-            # Then read it bit-by-bit, extending the current encoding
-            # that we are trying to decode.
-            for bit in bit_repr:
-                encoding += bit
-                # Is this a valid Huffman encoding?
-                if encoding in hc_decoding_table:
-                    # Yes, decompress it.
-                    decompressed_file.write(hc_decoding_table[encoding])
-                    num_decompressed += 1
-                    # If we have decompressed the expected amount of
-                    # characters, we are done; any leftover is just the
-                    # padding of the last byte of the file.
-                    if num_decompressed == num_chars:
-                        break
-                    encoding = ''
-            byte = compressed_file.read(1)
+        magic = compressed_file.read(len(BLOCK_MAGIC))
+        compressed_file.seek(0)
+        if magic == BLOCK_MAGIC:
+            decompress_blocks(compressed_file, decompressed_file, workers)
+            return
+        header = read_header(compressed_file)
+        if header is None:
+            # Not a canonical Huffman file; try the older format.
+            compressed_file.seek(0)
+            decompress_pickled(compressed_file, decompressed_file)
+        else:
+            code_lengths, num_chars = header
+            decompress_canonical(compressed_file, decompressed_file,
+                                 code_lengths, num_chars)
+
+def compress_block(text, code_lengths=None):
+    """Compress text into a self-contained block, with its own header.
+
+    If code_lengths is not given, we create a Huffman code for the block.
+    """
+    if code_lengths is None:
+        code_lengths = huffman_code_lengths(Counter(text))
+    compressed_file = io.BytesIO()
+    write_header(compressed_file, code_lengths, len(text))
+    compress_canonical(io.StringIO(text), compressed_file,
+                       canonical_code(code_lengths))
+    return compressed_file.getvalue()
+
+def decompress_block(data):
+    """Decompress a block created by compress_block."""
+    compressed_file = io.BytesIO(data)
+    code_lengths, num_chars = read_header(compressed_file)
+    decompressed_file = io.StringIO()
+    decompress_canonical(compressed_file, decompressed_file,
+                         code_lengths, num_chars)
+    return decompressed_file.getvalue()
+
+def map_in_order(executor, func, items, window):
+    """Apply func to items in executor, yielding the results in order.
+
+    Unlike executor.map, at most window items are submitted at any time,
+    so we do not need to keep all the items in memory.
+    """
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+def huffman_compress_blocks(input_file, output_file, block_size=BLOCK_SIZE,
+                            workers=None, code_lengths=None):
+    """Compress input_file in blocks of block_size characters.
+
+    The blocks are compressed in parallel by workers processes, each
+    block with its own Huffman code, unless a code shared by all blocks
+    is given in code_lengths. They are followed by an index that allows
+    us to decompress any part of the file without decompressing the
+    blocks before it. If a character has no code in code_lengths, we
+    remove output_file and raise ValueError.
+    """
+    workers = workers or os.cpu_count()
+    try:
+        with open(input_file) as uncompressed_file, \
+            open(output_file, 'wb') as compressed_file, \
+            ProcessPoolExecutor(workers) as executor:
+            compressed_file.write(BLOCK_MAGIC)
+            blocks = iter(lambda: uncompressed_file.read(block_size), '')
+            index = []
+            offset = len(BLOCK_MAGIC)
+            compress = functools.partial(compress_block,
+                                         code_lengths=code_lengths)
+            for data in map_in_order(executor, compress, blocks, 2 * workers):
+                # The number of characters of the block is in its header.
+                _, num_chars, _ = HEADER.unpack_from(data)
+                index.append((offset, len(data), num_chars))
+                compressed_file.write(data)
+                offset += len(data)
+            for entry in index:
+                compressed_file.write(BLOCK_ENTRY.pack(*entry))
+            compressed_file.write(BLOCK_TRAILER.pack(offset, len(index),
+                                                     BLOCK_MAGIC))
+    except ValueError:
+        # Do not leave a truncated file behind.
+        os.remove(output_file)
+        raise
+
+def read_block_index(compressed_file):
+    """Read the index of a file compressed in blocks.
+
+    Returns a list with the offset, the compressed size, and the number
+    of characters of each block.
+    """
+    compressed_file.seek(-BLOCK_TRAILER.size, io.SEEK_END)
+    index_offset, num_blocks, magic = BLOCK_TRAILER.unpack(
+        compressed_file.read(BLOCK_TRAILER.size))
+    if magic != BLOCK_MAGIC:
+        raise ValueError('missing block index')
+    compressed_file.seek(index_offset)
+    entries = compressed_file.read(num_blocks * BLOCK_ENTRY.size)
+    return list(BLOCK_ENTRY.iter_unpack(entries))
+
+def read_blocks(compressed_file, index):
+    for offset, size, _ in index:
+        compressed_file.seek(offset)
+        yield compressed_file.read(size)
+
+def decompress_blocks(compressed_file, decompressed_file, workers=None):
+    workers = workers or os.cpu_count()
+    index = read_block_index(compressed_file)
+    with ProcessPoolExecutor(workers) as executor:
+        for text in map_in_order(executor, decompress_block,
+                                 read_blocks(compressed_file, index),
+                                 2 * workers):
+            decompressed_file.write(text)
+
+def huffman_decompress_range(input_file, start, end, workers=None):
+    """Return characters start up to, not including, end of a file
+    compressed in blocks, decompressing only the blocks we need.
+    """
+    workers = workers or os.cpu_count()
+    with open(input_file, 'rb') as compressed_file:
+        index = read_block_index(compressed_file)
+        # Find the character at which each block starts.
+        block_starts = [0]
+        for _, _, num_chars in index:
+            block_starts.append(block_starts[-1] + num_chars)
+        start = max(0, min(start, block_starts[-1]))
+        end = max(start, min(end, block_starts[-1]))
+        if start == end:
+            return ''
+        first = bisect.bisect_right(block_starts, start) - 1
+        last = bisect.bisect_left(block_starts, end)
+        needed = index[first:last]
+        if len(needed) == 1:
+            texts = [decompress_block(next(read_blocks(compressed_file,
+                                                       needed)))]
+        else:
+            with ProcessPoolExecutor(workers) as executor:
+                texts = list(map_in_order(executor, decompress_block,
+                                          read_blocks(compressed_file,
+                                                      needed),
+                                          2 * workers))
+    text = ''.join(texts)
+    offset = block_starts[first]
+    return text[start - offset:end - offset]
+
+class AdaptiveHuffmanTree:
+    """An adaptive Huffman tree, updated with the FGK algorithm.
+
+    The nodes are kept in parallel arrays. Each node also has a number,
+    and the numbers are such that weights do not decrease as numbers
+    increase and siblings have consecutive numbers (the sibling
+    property). The root has the highest number and the NYT node the
+    lowest. Each time we see a symbol, we go from its leaf up to the
+    root; we swap each node on the way with the highest-numbered node
+    of the same weight, if that is not its parent, and then increase
+    its weight. This keeps the tree a Huffman tree for the symbols seen
+    so far.
+    """
+
+    def __init__(self):
+        # Every symbol and the NYT node have a leaf, and there is one
+        # less internal node than leaves.
+        size = 2 * (EOF_SYMBOL + 1) + 1
+        self.weight = [0] * size
+        self.parent = [-1] * size
+        self.left = [-1] * size
+        self.right = [-1] * size
+        self.symbol = [-1] * size
+        self.number = [0] * size
+        self.node_at = [-1] * size
+        self.leaf = [-1] * (EOF_SYMBOL + 1)
+        # At first the tree has only the NYT node, which is the root.
+        self.root = 0
+        self.nyt = 0
+        self.num_nodes = 1
+        self.number[0] = size - 1
+        self.node_at[size - 1] = 0
+
+    def code(self, node):
+        """Return the code of node as a (code, length) pair."""
+        code = 0
+        length = 0
+        while node != self.root:
+            parent = self.parent[node]
+            if self.right[parent] == node:
+                code |= 1 << length
+            length += 1
+            node = parent
+        return code, length
+
+    def encode(self, symbol):
+        """Return the (code, length) pair for symbol and update the tree."""
+        leaf = self.leaf[symbol]
+        if leaf == -1:
+            code, length = self.code(self.nyt)
+            code = (code << SYMBOL_BITS) | symbol
+            length += SYMBOL_BITS
+        else:
+            code, length = self.code(leaf)
+        self.update(symbol)
+        return code, length
+
+    def swap(self, a, b):
+        """Swap the subtrees rooted at a and b, and their numbers."""
+        parent, left, right = self.parent, self.left, self.right
+        pa = parent[a]
+        pb = parent[b]
+        if pa == pb:
+            left[pa], right[pa] = right[pa], left[pa]
+        else:
+            if left[pa] == a:
+                left[pa] = b
+            else:
+                right[pa] = b
+            if left[pb] == b:
+                left[pb] = a
+            else:
+                right[pb] = a
+            parent[a], parent[b] = pb, pa
+        na = self.number[a]
+        nb = self.number[b]
+        self.number[a], self.number[b] = nb, na
+        self.node_at[na], self.node_at[nb] = b, a
+
+    def update(self, symbol):
+        weight, number, node_at = self.weight, self.number, self.node_at
+        node = self.leaf[symbol]
+        if node == -1:
+            # Split the NYT node into a new NYT node, on the left, and
+            # a leaf for the symbol, on the right.
+            old_nyt = self.nyt
+            nyt = self.num_nodes
+            node = nyt + 1
+            self.num_nodes += 2
+            self.left[old_nyt] = nyt
+            self.right[old_nyt] = node
+            self.parent[nyt] = self.parent[node] = old_nyt
+            number[node] = number[old_nyt] - 1
+            number[nyt] = number[old_nyt] - 2
+            node_at[number[node]] = node
+            node_at[number[nyt]] = nyt
+            self.symbol[node] = symbol
+            self.leaf[symbol] = node
+            self.nyt = nyt
+        highest = len(node_at) - 1
+        while node != -1:
+            # Find the highest-numbered node with the same weight.
+            n = number[node]
+            w = weight[node]
+            while n < highest and weight[node_at[n + 1]] == w:
+                n += 1
+            leader = node_at[n]
+            if leader != node and leader != self.parent[node]:
+                self.swap(node, leader)
+            weight[node] += 1
+            node = self.parent[node]
+
+def adaptive_huffman_encode(chunks):
+    """Encode an iterable of byte chunks with adaptive Huffman coding.
+
+    This is a generator, yielding a chunk of the compressed stream for
+    each chunk of input, so it needs a single pass over its input and
+    constant memory.
+    """
+    tree = AdaptiveHuffmanTree()
+    yield ADAPTIVE_MAGIC
+    acc = 0
+    nbits = 0
+    buffer = bytearray()
+    for chunk in chunks:
+        for symbol in chunk:
+            code, length = tree.encode(symbol)
+            acc = (acc << length) | code
+            nbits += length
+            while nbits >= 64:
+                nbits -= 64
+                buffer += (acc >> nbits).to_bytes(8, byteorder='big')
+                acc &= (1 << nbits) - 1
+        yield bytes(buffer)
+        buffer.clear()
+    code, length = tree.encode(EOF_SYMBOL)
+    acc = (acc << length) | code
+    nbits += length
+    # Pad the last bits with zeroes up to a whole byte.
+    num_bytes = (nbits + 7) // 8
+    acc <<= 8 * num_bytes - nbits
+    yield acc.to_bytes(num_bytes, byteorder='big')
+
+def adaptive_huffman_decode(chunks):
+    """Decode an iterable of chunks of an adaptive Huffman stream.
+
+    This is a generator, yielding the bytes decoded from each chunk.
+    """
+    chunks = iter(chunks)
+    # Check the magic number, which may be split across chunks.
+    start = b''
+    while len(start) < len(ADAPTIVE_MAGIC):
+        chunk = next(chunks, b'')
+        if not chunk:
+            break
+        start += chunk
+    if start[:len(ADAPTIVE_MAGIC)] != ADAPTIVE_MAGIC:
+        raise ValueError('not an adaptive Huffman stream')
+    tree = AdaptiveHuffmanTree()
+    left, right = tree.left, tree.right
+    node = tree.root
+    # The number of bits of a new symbol we still have to read, and the
+    # bits we have read so far. As the tree starts with just the NYT
+    # node, the stream starts with a new symbol.
+    symbol_bits = SYMBOL_BITS
+    value = 0
+    for chunk in itertools.chain([start[len(ADAPTIVE_MAGIC):]], chunks):
+        buffer = bytearray()
+        for byte in chunk:
+            for shift in range(7, -1, -1):
+                bit = (byte >> shift) & 1
+                if symbol_bits > 0:
+                    value = (value << 1) | bit
+                    symbol_bits -= 1
+                    if symbol_bits > 0:
+                        continue
+                    symbol = value
+                else:
+                    node = right[node] if bit else left[node]
+                    if left[node] != -1:
+                        continue
+                    if node == tree.nyt:
+                        symbol_bits = SYMBOL_BITS
+                        value = 0
+                        continue
+                    symbol = tree.symbol[node]
+                if symbol == EOF_SYMBOL:
+                    yield bytes(buffer)
+                    return
+                buffer.append(symbol)
+                tree.update(symbol)
+                node = tree.root
+        yield bytes(buffer)
+    raise ValueError('adaptive Huffman stream ends without end of stream')
+
+def read_chunks(binary_file, chunk_size=CHUNK_SIZE):
+    """Yield the chunks of binary_file as soon as they are available."""
+    return iter(lambda: binary_file.read1(chunk_size), b'')
+
+def write_chunks(binary_file, chunks):
+    for chunk in chunks:
+        binary_file.write(chunk)
+        binary_file.flush()
+
+def open_binary(filename, mode):
+    """Open filename in binary mode; '-' stands for stdin or stdout."""
+    if filename == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return open(stream.fileno(), mode, closefd=False)
+    return open(filename, mode)
+
+def adaptive_huffman_compress(input_file, output_file):
+    with open_binary(input_file, 'rb') as uncompressed_file, \
+        open_binary(output_file, 'wb') as compressed_file:
+        write_chunks(compressed_file,
+                     adaptive_huffman_encode(read_chunks(uncompressed_file)))
+
+def adaptive_huffman_decompress(input_file, output_file):
+    with open_binary(input_file, 'rb') as compressed_file, \
+        open_binary(output_file, 'wb') as decompressed_file:
+        write_chunks(decompressed_file,
+                     adaptive_huffman_decode(read_chunks(compressed_file)))
 
 if __name__ == "__main__":            
     parser = argparse.ArgumentParser(description=
                                      'Huffman compression/decompression')
 
-    parser.add_argument('input_file', help='Input file')
-    parser.add_argument('output_file', help='Output file')
+    parser.add_argument('input_file', help='Input file, - for stdin')
+    parser.add_argument('output_file', help='Output file, - for stdout')
     parser.add_argument('-d', '--decompress',
                         action='store_true',
                         help='Decompress',
                         default=False)
+    parser.add_argument('-a', '--adaptive',
+                        action='store_true',
+                        help='use one-pass adaptive Huffman coding',
+                        default=False)
+    parser.add_argument('-b', '--block_size',
+                        help='compress in blocks of this many characters',
+                        type=int)
+    parser.add_argument('-j', '--jobs',
+                        help='number of processes for block mode',
+                        type=int)
+    parser.add_argument('-r', '--range', nargs=2, type=int,
+                        metavar=('START', 'END'),
+                        help='decompress only characters START to END '
+                        'of a file compressed in blocks')
+    parser.add_argument('-t', '--table',
+                        help='compress with the code table in this CSV file '
+                        'instead of counting characters; each row has a '
+                        'character and its code, and the codes must form a '
+                        'binary prefix code covering every character of '
+                        'the input')
+    parser.add_argument('-s', '--save_table',
+                        help='save the code table in this CSV file')
 
     args = parser.parse_args()
 
-    if args.decompress:
-        huffman_decompress(args.input_file, args.output_file)
+    if (args.input_file == '-' or args.output_file == '-') \
+       and not args.adaptive:
+        parser.error('stdin and stdout can only be used with --adaptive')
+
+    if args.adaptive:
+        if args.decompress:
+            adaptive_huffman_decompress(args.input_file, args.output_file)
+        else:
+            adaptive_huffman_compress(args.input_file, args.output_file)
+    elif args.range:
+        text = huffman_decompress_range(args.input_file, *args.range,
+                                        workers=args.jobs)
+        with open(args.output_file, 'w') as decompressed_file:
+            decompressed_file.write(text)
+    elif args.decompress:
+        huffman_decompress(args.input_file, args.output_file, args.jobs)
     else:
-        huffman_compress(args.input_file, args.output_file)
+        code_lengths = None
+        if args.table:
+            code_lengths = read_code_table(args.table)
+        if args.block_size:
+            if args.save_table:
+                # A saved table must be shared by all the blocks.
+                if code_lengths is None:
+                    code_lengths = huffman_code_lengths(
+                        count_characters(args.input_file))
+                write_code_table(args.save_table, code_lengths)
+            huffman_compress_blocks(args.input_file, args.output_file,
+                                    args.block_size, args.jobs, code_lengths)
+        else:
+            huffman_compress(args.input_file, args.output_file, code_lengths,
+                             args.save_table)
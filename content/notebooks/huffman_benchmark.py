@@ -0,0 +1,170 @@
+import argparse
+import io
+import random
+import time
+
+from collections import Counter
+
+import huffman
+
+from huffman import canonical_code, compress_canonical, huffman_code_lengths
+from huffman import decompress_canonical
+from huffman import create_pq, insert_in_pq, create_huffman_code
+from huffman import package_merge
+
+def string_buffer_encode(uncompressed_file, compressed_file, codes):
+    """Encode the way huffman_compress used to, for comparison.
+
+    The codes are kept as strings of '0' and '1'; they are appended to a
+    string buffer, which is sliced and written out a byte at a time.
+    """
+    hc_table = { character: format(code, '0{}b'.format(length))
+                 for (character, (code, length)) in codes.items() }
+    buffer = ''
+    for line in uncompressed_file:
+        for c in line:
+            buffer += hc_table[c]
+            while len(buffer) >= 8:
+                byte = int(buffer[:8], base=2).to_bytes(1, byteorder='big')
+                compressed_file.write(byte)
+                buffer = buffer[8:]
+    if len(buffer) > 0:
+        buffer = buffer.ljust(8, '0')
+        byte = int(buffer[:8], base=2).to_bytes(1, byteorder='big')
+        compressed_file.write(byte)
+
+ENCODERS = {
+    'string buffer': string_buffer_encode,
+    'bit accumulator': compress_canonical,
+}
+
+def benchmark_encoders(input_file, repeat):
+    with open(input_file) as uncompressed_file:
+        text = uncompressed_file.read()
+    size = len(text.encode()) / 2**20
+    codes = canonical_code(huffman_code_lengths(Counter(text)))
+    results = {}
+    for name, encoder in ENCODERS.items():
+        best = None
+        for _ in range(repeat):
+            compressed_file = io.BytesIO()
+            start = time.perf_counter()
+            encoder(io.StringIO(text), compressed_file, codes)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (compressed_file.getvalue(), best)
+    outputs = { output for (output, _) in results.values() }
+    if len(outputs) != 1:
+        raise RuntimeError('encoders produced different output')
+    for name, (_, elapsed) in results.items():
+        print('{}: {:.2f} MB/s'.format(name, size / elapsed))
+
+def textbook_code_lengths(symb2freq):
+    """Find the code lengths with create_huffman_code, for comparison."""
+    pq = create_pq()
+    for key, value in symb2freq.items():
+        insert_in_pq(pq, [value, [key, '']])
+    hc = create_huffman_code(pq)
+    return { symbol: len(encoding) for [symbol, encoding] in hc[1:] }
+
+def benchmark_tree_builders(sizes, max_textbook_size, max_length, seed):
+    random.seed(seed)
+    builders = {
+        'textbook': textbook_code_lengths,
+        'two queues': huffman_code_lengths,
+        'package-merge': lambda symb2freq: package_merge(symb2freq, max_length)
+    }
+    print('{:>10} {:>15} {:>12}'.format('symbols', 'builder', 'seconds'))
+    for size in sizes:
+        # Zipf-like frequencies, as in natural text.
+        symb2freq = { symbol: int(2**20 / (symbol + 1)) + random.randint(1, 8)
+                      for symbol in range(size) }
+        for name, builder in builders.items():
+            if name == 'textbook' and size > max_textbook_size:
+                continue
+            start = time.perf_counter()
+            builder(symb2freq)
+            elapsed = time.perf_counter() - start
+            print('{:>10} {:>15} {:>12.4f}'.format(size, name, elapsed))
+
+def round_trip(text, chunk_size=None):
+    """Compress and decompress text in memory, optionally with a smaller
+    CHUNK_SIZE, so that the decoder flushes its output more often."""
+    code_lengths = huffman_code_lengths(Counter(text))
+    compressed_file = io.BytesIO()
+    num_chars = compress_canonical(io.StringIO(text), compressed_file,
+                                   canonical_code(code_lengths))
+    compressed_file.seek(0)
+    decompressed_file = io.StringIO()
+    saved_chunk_size = huffman.CHUNK_SIZE
+    if chunk_size is not None:
+        huffman.CHUNK_SIZE = chunk_size
+    try:
+        decompress_canonical(compressed_file, decompressed_file,
+                             code_lengths, num_chars)
+    finally:
+        huffman.CHUNK_SIZE = saved_chunk_size
+    return decompressed_file.getvalue() == text
+
+def check_round_trips(count, seed):
+    """Check round trips of inputs whose last table lookup goes past the
+    last character, into the padding, just as the decoder flushes."""
+    random.seed(seed)
+    # 'ab' codes take one bit, so the last lookup decodes up to
+    # LOOKUP_BITS characters of padding, at the 196608th character
+    # where the decoder flushes.
+    inputs = [(('ab' * 200000)[:196603], None)]
+    for _ in range(count):
+        length = random.randint(1, 5000)
+        text = ''.join(random.choice('aab cd') for _ in range(length))
+        inputs.append((text, 128))
+    failures = sum(not round_trip(text, chunk_size)
+                   for (text, chunk_size) in inputs)
+    print('{} of {} round trips failed'.format(failures, len(inputs)))
+    if failures:
+        raise RuntimeError('round trip failed')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Huffman benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    encode_parser = subparsers.add_parser('encode',
+                                          help='compare Huffman encoders')
+    encode_parser.add_argument('input_file', nargs='+', help='Input file')
+    encode_parser.add_argument('-r', '--repeat',
+                               help='number of runs of each encoder',
+                               type=int, default=3)
+
+    tree_parser = subparsers.add_parser('tree',
+                                        help='compare Huffman tree builders')
+    tree_parser.add_argument('-s', '--sizes', nargs='+',
+                             help='alphabet sizes', type=int,
+                             default=[2**8, 2**12, 2**16, 2**18, 2**20])
+    tree_parser.add_argument('-t', '--max_textbook_size',
+                             help='largest alphabet for create_huffman_code',
+                             type=int, default=2**16)
+    tree_parser.add_argument('-l', '--max_length',
+                             help='code length limit for package-merge',
+                             type=int, default=24)
+    tree_parser.add_argument('--seed', help='random seed', type=int,
+                             default=42)
+
+    check_parser = subparsers.add_parser('check',
+                                         help='check decoder round trips')
+    check_parser.add_argument('-c', '--count',
+                              help='number of random inputs',
+                              type=int, default=100)
+    check_parser.add_argument('--seed', help='random seed', type=int,
+                              default=42)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'check':
+        check_round_trips(args.count, args.seed)
+    elif args.benchmark == 'encode':
+        for input_file in args.input_file:
+            print(input_file)
+            benchmark_encoders(input_file, args.repeat)
+    else:
+        benchmark_tree_builders(args.sizes, args.max_textbook_size,
+                                args.max_length, args.seed)
@@ -1,147 +1,607 @@
 import argparse
+import hashlib
+import os
+import struct
+import sys
 
-def lzw_compress(input_file, output_file, nb, n):
+from array import array
+
+# The first code after the alphabet is the CLEAR code, which tells the
+# decoder to reset its table, and the second is the STOP code, which
+# ends the stream, so that the decoder does not take the padding of the
+# last byte for codes.
+# Once the table is full, we check the compression ratio every CHECK_GAP
+# input characters, and if it has dropped we reset the table.
+CHECK_GAP = 10000
+
+# A compressed file starts with MAGIC, the maximum number of bits of
+# the codes, the size of the alphabet, and the identifier of the
+# dictionary the table was preloaded with, or NO_DICTIONARY.
+MAGIC = b'LZW2'
+HEADER = struct.Struct('>4sBII')
+NO_DICTIONARY = 0
+
+# A dictionary file starts with DICTIONARY_MAGIC, the size of the
+# alphabet, the identifier of the dictionary, and the number of its
+# entries. Then come the prefix encodings of the entries, followed by
+# their last symbols, as arrays of 32-bit integers.
+DICTIONARY_MAGIC = b'LZD2'
+DICTIONARY_HEADER = struct.Struct('>4sIII')
+
+# The size of the blocks we read, and the amount of output we collect
+# before writing it out.
+CHUNK_SIZE = 2**20
+
+def lzw_encode(chunks, nb, n, dictionary=()):
     """ 
-    Perform LZW compression.
+    Perform LZW compression on a stream.
+
+    Codes start with as many bits as needed for the alphabet and the
+    CLEAR and STOP codes (9 bits for n = 256) and grow by one bit each time the
+    table outgrows them, up to nb bits. They are packed together in the
+    output, without regard to byte boundaries. When the table is full
+    and the compression ratio drops, we output the CLEAR code and start
+    again with a new table. The STOP code ends the output.
+
+    The table can be preloaded with a dictionary; then ngrams that are
+    frequent in the data the dictionary was trained on get short codes
+    from the start.
     
     Parameters
     ----------
-    message : str
-        the message to compress
+    chunks : iterable
+        the message to compress, as chunks of symbols, i.e., integers
+        smaller than n, such as bytes or memoryview objects
     nb : int
-        the number of bits used for each encoding
+        the maximum number of bits used for each encoding
     n : int
         the size of the alphabet
+    dictionary : sequence
+        the (prefix encoding, last symbol) pairs of the ngrams to preload
+        the table with, as returned by lzw_train
         
-    Returns
-    -------
-    compressed : list
-       The encoded message
+    Yields
+    ------
+    compressed : bytes
+       The encoded message, in chunks of about CHUNK_SIZE bytes
     """
 
-    uncompressed_file = open(input_file)
-    compressed_file = open(output_file, 'wb')
-    
     max_code = 2**nb - 1 # size of the encoding table
-    # Initialize table with encodings for each character
-    # in the alphabet.
-    table = { chr(i): i for i in range(n) }
-    code = n # this is the encoding for the next unencoded ngram
-    # The necessary bytes to store nb bits nb // 8 rounded up to
-    # next integer; to do that, we add 7 to nb.
-    num_bytes = (nb + 7) // 8 
+    clear_code = n
+    stop_code = n + 1
+    first_code = n + 2
+    if first_code + len(dictionary) > max_code:
+        raise ValueError('{} bits are too few for an alphabet of {} '
+                         'and {} dictionary entries'.format(nb, n,
+                                                            len(dictionary)))
+    # The table maps each ngram, other than single symbols, to its
+    # encoding. An ngram is the ngram formed by its prefix and its last
+    # symbol, so we use as key the encoding of the prefix and the last
+    # symbol, packed in one integer. The encoding of a single symbol is
+    # the symbol itself.
+    initial_table = { prefix * n + last: first_code + i
+                      for i, (prefix, last) in enumerate(dictionary) }
+    table = dict(initial_table)
+    first_unused = first_code + len(dictionary)
+    code = first_unused # this is the encoding for the next unencoded ngram
+    # The number of bits we need for the largest code in the table.
+    width = (code - 1).bit_length()
+
+    # Bits waiting to be output, and their number.
+    acc = 0
+    nbits = 0
+    buffer = bytearray()
+    # Symbols read and bits written since the last reset, and the
+    # best compression ratio since then.
+    in_count = 0
+    out_bits = 0
+    ratio = 0
+    checkpoint = CHECK_GAP
     
-    w = "" # current ngram
-    for line in uncompressed_file:
-        for c in line:
-            wc = w + c # form new ngram
+    w = -1 # encoding of current ngram; -1 for the empty ngram
+    for chunk in chunks:
+        if len(chunk) > 0 and max(chunk) >= n:
+            raise ValueError('symbol {} is not in the alphabet'.format(
+                max(chunk)))
+        for c in chunk:
+            in_count += 1
+            if w == -1:
+                w = c
+                continue
             # If we have already encountered the new ngram
-            # prepare to add another character to it.
-            if wc in table:
+            # prepare to add another symbol to it.
+            wc = table.get(w * n + c)
+            if wc is not None:
                 w = wc
-            else:
-                # Otherwise we must put out the encoding of the
-                # existing ngram.
-                compressed_file.write(table[w].to_bytes(num_bytes,
-                                                        byteorder='big'))
-                # Start an ngram from the current character.
-                w = c            
-                # Check if we can add the non-found ngram
-                # in the table and add it if possible.
-                if code <= max_code:
-                    table[wc] = code
-                    code += 1
-    # If we have finished the input file, output the encoding of the
+                continue
+            # Otherwise we must put out the encoding of the
+            # existing ngram.
+            acc = (acc << width) | w
+            nbits += width
+            out_bits += width
+            if nbits >= 64:
+                nbits -= 64
+                buffer += (acc >> nbits).to_bytes(8, byteorder='big')
+                acc &= (1 << nbits) - 1
+            # Check if we can add the non-found ngram
+            # in the table and add it if possible.
+            if code <= max_code:
+                table[w * n + c] = code
+                code += 1
+                width = (code - 1).bit_length()
+            elif in_count >= checkpoint:
+                # The table is full; if the compression ratio has
+                # dropped, reset the table.
+                checkpoint = in_count + CHECK_GAP
+                if in_count / out_bits >= ratio:
+                    ratio = in_count / out_bits
+                else:
+                    acc = (acc << width) | clear_code
+                    nbits += width
+                    table = dict(initial_table)
+                    code = first_unused
+                    width = (code - 1).bit_length()
+                    in_count = 0
+                    out_bits = 0
+                    ratio = 0
+                    checkpoint = CHECK_GAP
+            # Start an ngram from the current symbol.
+            w = c
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    # If we have finished the input, output the encoding of the
     # current ngram.
-    if w:
-        compressed_file.write(table[w].to_bytes(num_bytes, byteorder='big'))
-    
-    uncompressed_file.close()
-    compressed_file.close()
+    if w != -1:
+        acc = (acc << width) | w
+        nbits += width
+        # The decoder adds an entry for the last ngram, which we do not,
+        # so the STOP code may need one more bit.
+        if code <= max_code:
+            width = code.bit_length()
+    acc = (acc << width) | stop_code
+    nbits += width
+    # Pad the remaining bits with zeroes up to a whole byte; the decoder
+    # stops at the STOP code, before the padding.
+    num_bytes = (nbits + 7) // 8
+    acc <<= 8 * num_bytes - nbits
+    buffer += acc.to_bytes(num_bytes, byteorder='big')
+    yield bytes(buffer)
 
 
-def lzw_decompress(input_file, output_file, nb, n):
+def lzw_decode(chunks, nb, n, dictionary=()):
     """ 
-    Perform LZW decompression.
+    Perform LZW decompression on a stream.
     
+    The decoder adds each table entry one code later than the encoder,
+    so when it reads a code it allows for the entry that the encoder has
+    already added in calculating the width of the code.
+
     Parameters
     ----------
-    compressed : list
-        the message to decompress
+    chunks : iterable
+        the message to decompress, as chunks of bytes
     nb : int
-        the number of bits used for each encoding
+        the maximum number of bits used for each encoding
     n : int
         the size of the alphabet
+    dictionary : sequence
+        the dictionary the table was preloaded with when compressing
         
-    Returns
-    -------
-    result : str
-        The decompressed message
+    Yields
+    ------
+    result : array
+        The decompressed message, in chunks of about CHUNK_SIZE symbols;
+        the arrays have typecode 'B' if n <= 256, so they can be
+        written directly to a binary file
     """
    
     max_code = 2**nb - 1 # size of the decoding table
-    # Initialize the decoding table with reverse encodings 
-    # for each character in the alphabet.
-    table = { i : chr(i) for i in range(n) }
-    code = n # this is the encoding for the next unencoded ngram
-    # The necessary bytes to store nb bits nb // 8 rounded up to
-    # next integer; to do that, we add 7 to nb.
-    num_bytes = (nb + 7) // 8
+    clear_code = n
+    stop_code = n + 1
+    first_code = n + 2
+    # The decoding table keeps, for each encoding, the encoding of the
+    # prefix of its ngram, its last symbol, its first symbol, and its
+    # length. Single symbols have no prefix.
+    # We rebuild ngrams backwards in a buffer that we reuse, following
+    # the prefixes.
+    typecode = 'B' if n <= 256 else 'I'
+    prefix = array('l', [-1] * first_code)
+    last = array(typecode, range(n)) + array(typecode, [0, 0])
+    first = array(typecode, last)
+    length = array('l', [1] * n + [0, 0])
+    for prefix_code, last_symbol in dictionary:
+        prefix.append(prefix_code)
+        last.append(last_symbol)
+        first.append(first[prefix_code])
+        length.append(length[prefix_code] + 1)
+    ngram = array(typecode, [0])
+    first_unused = first_code + len(dictionary)
+    code = first_unused # this is the encoding for the next unencoded ngram
+
+    acc = 0
+    nbits = 0
+    pv = -1 # previous encoding
+    
+    output = array(typecode)
+    for data in chunks:
+        pos = 0
+        while True:
+            # Find the width of the next code; if the encoder has added
+            # an entry we have not added yet, it may need one more bit.
+            if pv != -1 and code <= max_code:
+                width = code.bit_length()
+            else:
+                width = (code - 1).bit_length()
+            if nbits < width:
+                # Get more bits from the chunk.
+                if pos == len(data):
+                    break
+                more = data[pos:pos + 8]
+                pos += len(more)
+                acc = (acc << (8 * len(more))) | int.from_bytes(
+                    more, byteorder='big')
+                nbits += 8 * len(more)
+                continue
+            nbits -= width
+            c = acc >> nbits
+            acc &= (1 << nbits) - 1
+            if c == clear_code:
+                del prefix[first_unused:], last[first_unused:]
+                del first[first_unused:], length[first_unused:]
+                code = first_unused
+                pv = -1
+                continue
+            if c == stop_code:
+                yield output
+                return
+
+            # If there is room in the decoding table, add the previous
+            # ngram followed by the first symbol of the current one.
+            # If we do not know the current one, it is the entry we are
+            # adding: the previous ngram with its first symbol appended
+            # to its end.
+            if pv != -1 and code <= max_code:
+                prefix.append(pv)
+                last.append(first[c] if c < code else first[pv])
+                first.append(first[pv])
+                length.append(length[pv] + 1)
+                code += 1
+
+            # Rebuild the ngram of c.
+            k = length[c]
+            if k > len(ngram):
+                ngram.extend([0] * (k - len(ngram)))
+            i = k
+            p = c
+            while p >= n:
+                i -= 1
+                ngram[i] = last[p]
+                p = prefix[p]
+            ngram[0] = p
+            output.extend(ngram[:k])
+
+            pv = c
+        if len(output) >= CHUNK_SIZE:
+            yield output
+            output = array(typecode)
+    raise ValueError('the compressed stream ends without a STOP code')
+
+def lzw_train(samples, nb, n, size=None):
+    """
+    Train an LZW dictionary on sample data.
+
+    We run the LZW encoder over the samples, continuing with the same
+    table from one sample to the next, until the table has size entries.
+    
+    Parameters
+    ----------
+    samples : iterable
+        the samples, each an iterable of chunks of symbols
+    nb : int
+        the maximum number of bits used for each encoding
+    n : int
+        the size of the alphabet
+    size : int
+        the number of entries of the dictionary; by default half the
+        entries the table can have, leaving the rest to be learned
+        from the data we compress
+        
+    Returns
+    -------
+    dictionary : list
+        The (prefix encoding, last symbol) pair of each entry
+    """
+    first_code = n + 2
+    if size is None:
+        size = (2**nb - first_code) // 2
+    table = {}
+    dictionary = []
+    for chunks in samples:
+        w = -1
+        for chunk in chunks:
+            for c in chunk:
+                if c >= n:
+                    raise ValueError('symbol {} is not in the alphabet'.format(
+                        c))
+                if w == -1:
+                    w = c
+                    continue
+                wc = table.get(w * n + c)
+                if wc is not None:
+                    w = wc
+                    continue
+                if len(dictionary) == size:
+                    return dictionary
+                table[w * n + c] = first_code + len(dictionary)
+                dictionary.append((w, c))
+                w = c
+    return dictionary
+
+def dictionary_id(dictionary, n):
+    """Return a non-zero 32-bit identifier for the dictionary."""
+    digest = hashlib.sha256(struct.pack('>I', n))
+    for entry in dictionary:
+        digest.update(struct.pack('>II', *entry))
+    return int.from_bytes(digest.digest()[:4], byteorder='big') or 1
+
+def save_dictionary(dictionary_file, dictionary, n):
+    with open(dictionary_file, 'wb') as output:
+        output.write(DICTIONARY_HEADER.pack(DICTIONARY_MAGIC, n,
+                                            dictionary_id(dictionary, n),
+                                            len(dictionary)))
+        prefixes = array('I', (prefix for (prefix, _) in dictionary))
+        lasts = array('I', (last for (_, last) in dictionary))
+        if sys.byteorder == 'little':
+            prefixes.byteswap()
+            lasts.byteswap()
+        output.write(prefixes.tobytes())
+        output.write(lasts.tobytes())
+
+def load_dictionary(dictionary_file):
+    """
+    Load a dictionary saved with save_dictionary.
+        
+    Returns
+    -------
+    dictionary, n, dict_id : list, int, int
+        The dictionary, the size of the alphabet it is for, and its
+        identifier
+    """
+    with open(dictionary_file, 'rb') as input:
+        magic, n, dict_id, size = DICTIONARY_HEADER.unpack(
+            input.read(DICTIONARY_HEADER.size))
+        if magic != DICTIONARY_MAGIC:
+            raise ValueError('{} is not an LZW dictionary'.format(
+                dictionary_file))
+        prefixes = array('I')
+        lasts = array('I')
+        prefixes.frombytes(input.read(4 * size))
+        lasts.frombytes(input.read(4 * size))
+    if sys.byteorder == 'little':
+        prefixes.byteswap()
+        lasts.byteswap()
+    dictionary = list(zip(prefixes, lasts))
+    # Each entry must extend an earlier one.
+    for i, (prefix, last) in enumerate(dictionary):
+        if prefix >= n + 2 + i or n <= prefix < n + 2 or last >= n:
+            raise ValueError('invalid entry {} in {}'.format(
+                i, dictionary_file))
+    return dictionary, n, dict_id
+
+def open_file(filename, mode):
+    """Open filename; '-' stands for stdin or stdout."""
+    if filename == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return open(stream.fileno(), mode, closefd=False)
+    return open(filename, mode)
+
+def read_blocks(binary_file):
+    """Read binary_file in blocks of CHUNK_SIZE bytes.
+
+    We read into the same buffer every time and yield memoryview
+    slices of it, so each block must be used before asking for the next.
+    """
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    size = binary_file.readinto(buffer)
+    while size:
+        yield view[:size]
+        size = binary_file.readinto(buffer)
+
+def read_text(text_file, n):
+    """Read text_file in blocks of CHUNK_SIZE characters, and yield the
+    code points of the characters of each block.
+    """
+    block = text_file.read(CHUNK_SIZE)
+    while block:
+        if n <= 256:
+            try:
+                yield block.encode('latin-1')
+            except UnicodeEncodeError as e:
+                raise ValueError('character {!r} is not in the alphabet'.format(
+                    e.object[e.start])) from None
+        else:
+            yield array('I', map(ord, block))
+        block = text_file.read(CHUNK_SIZE)
+
+def sample_files(path):
+    """Return the files in path, if it is a directory, or path itself."""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(dirpath, filename)
+                  for (dirpath, _, filenames) in os.walk(path)
+                  for filename in filenames)
+
+def read_samples(paths, n, binary):
+    for path in paths:
+        with open(path, 'rb' if binary else 'r') as sample_file:
+            if binary:
+                yield read_blocks(sample_file)
+            else:
+                yield read_text(sample_file, n)
+
+def lzw_train_file(input_path, dictionary_file, nb, n, binary=False,
+                   size=None):
+    """
+    Train an LZW dictionary and save it.
     
-    compressed_file = open(input_file, 'rb')
-    decompressed_file = open(output_file, 'w')
-    # Output the first character.
-    bytes = compressed_file.read(num_bytes)
-    c = int.from_bytes(bytes, byteorder='big')
-    v = table[c]
-    decompressed_file.write(v)
-    pv = v # previous
+    Parameters
+    ----------
+    input_path : str
+        a sample file, or a directory whose files are all samples
+    dictionary_file : str
+        the name of the file in which to save the dictionary
+    nb : int
+        the maximum number of bits used for each encoding
+    n : int
+        the size of the alphabet
+    binary : bool
+        whether to train on the bytes of the samples instead of their
+        characters
+    size : int
+        the number of entries of the dictionary
+    """
+    dictionary = lzw_train(read_samples(sample_files(input_path), n, binary),
+                           nb, n, size)
+    save_dictionary(dictionary_file, dictionary, n)
+
+def lzw_compress(input_file, output_file, nb, n, binary=False,
+                 dictionary_file=None):
+    """ 
+    Perform LZW compression.
     
-    # For each encoded value in the compressed message:
-    bytes = compressed_file.read(num_bytes)
-    while bytes:
-        c = int.from_bytes(bytes, byteorder='big')
-        # If we know the corresponding ngram, get it.
-        if c in table:
-            v = table[c]
-        # If we do not know it, the corresponding ngram
-        # is really the previous ngram with its first
-        # character appended to its end.
+    Parameters
+    ----------
+    input_file : str
+        the name of the file to compress; '-' for stdin
+    output_file : str
+        the name of the compressed file; '-' for stdout
+    nb : int
+        the maximum number of bits used for each encoding
+    n : int
+        the size of the alphabet
+    binary : bool
+        whether to compress the bytes of the file instead of its characters
+    dictionary_file : str
+        the name of a dictionary file to preload the table with
+    """
+
+    dictionary = ()
+    dict_id = NO_DICTIONARY
+    if dictionary_file is not None:
+        dictionary, dictionary_n, dict_id = load_dictionary(dictionary_file)
+        if dictionary_n != n:
+            raise ValueError('{} is for an alphabet of {}'.format(
+                dictionary_file, dictionary_n))
+    with open_file(input_file, 'rb' if binary else 'r') as uncompressed_file, \
+        open_file(output_file, 'wb') as compressed_file:
+        compressed_file.write(HEADER.pack(MAGIC, nb, n, dict_id))
+        if binary:
+            chunks = read_blocks(uncompressed_file)
         else:
-            v = pv + pv[0]
+            chunks = read_text(uncompressed_file, n)
+        for compressed in lzw_encode(chunks, nb, n, dictionary):
+            compressed_file.write(compressed)
 
-        decompressed_file.write(v)
 
-        # If there is room in the decoding table:
-        if code <= max_code:
-            # add the new mapping to it.
-            table[code] = pv + v[0]
-            code += 1
-            
-        pv = v
-        bytes = compressed_file.read(num_bytes)
+def lzw_decompress(input_file, output_file, nb, n, binary=False,
+                   dictionary_file=None):
+    """ 
+    Perform LZW decompression.
+    
+    Parameters
+    ----------
+    input_file : str
+        the name of the file to decompress; '-' for stdin
+    output_file : str
+        the name of the decompressed file; '-' for stdout
+    nb : int
+        the maximum number of bits used for each encoding
+    n : int
+        the size of the alphabet
+    binary : bool
+        whether the compressed file contains bytes instead of characters
+    dictionary_file : str
+        the name of the dictionary file used for compression
+    """
 
-    decompressed_file.close()
-    compressed_file.close()
+    if binary and n > 256:
+        raise ValueError('binary files need an alphabet of at most 256')
+    dictionary = ()
+    dict_id = NO_DICTIONARY
+    if dictionary_file is not None:
+        dictionary, dictionary_n, dict_id = load_dictionary(dictionary_file)
+        if dictionary_n != n:
+            raise ValueError('{} is for an alphabet of {}'.format(
+                dictionary_file, dictionary_n))
+    with open_file(input_file, 'rb') as compressed_file:
+        # Check the header before we create the output file.
+        header = compressed_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('not an LZW compressed file')
+        magic, stream_nb, stream_n, stream_dict_id = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('not an LZW compressed file')
+        if (stream_nb, stream_n) != (nb, n):
+            raise ValueError('the file was compressed with nb={} and n={}, '
+                             'not nb={} and n={}'.format(stream_nb, stream_n,
+                                                         nb, n))
+        if stream_dict_id != dict_id:
+            raise ValueError('the file was compressed with {}'.format(
+                'no dictionary' if stream_dict_id == NO_DICTIONARY
+                else 'dictionary {:08x}'.format(stream_dict_id)))
+        with open_file(output_file, 'wb' if binary else 'w') as \
+             decompressed_file:
+            for output in lzw_decode(read_blocks(compressed_file), nb, n,
+                                     dictionary):
+                if binary:
+                    decompressed_file.write(output)
+                elif n <= 256:
+                    decompressed_file.write(
+                        output.tobytes().decode('latin-1'))
+                else:
+                    decompressed_file.write(''.join(map(chr, output)))
 
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description=
                                      "LZW compression/decompression")
 
-    parser.add_argument('input_file', help='Input file')
-    parser.add_argument('output_file', help='Output file')
+    parser.add_argument('input_file', help='Input file, - for stdin')
+    parser.add_argument('output_file', help='Output file, - for stdout')
     parser.add_argument("-d", "--decompress", help="decompress",
                         default=False,
                         action="store_true")
-    parser.add_argument("-n", "--nb", help="number of bits of each table entry",
+    parser.add_argument("-n", "--nb",
+                        help="maximum number of bits of each table entry",
                         type=int, default=16)
     parser.add_argument("-s", "--size", help="size of alphabet",
                         type=int, default=2**8)
+    parser.add_argument("-b", "--binary",
+                        help="compress bytes instead of characters",
+                        default=False,
+                        action="store_true")
+    parser.add_argument("-t", "--train",
+                        help="train a dictionary on the input file, or "
+                        "the files of the input directory, and save it "
+                        "in the output file",
+                        default=False,
+                        action="store_true")
+    parser.add_argument("--dictionary_size",
+                        help="number of entries of a trained dictionary",
+                        type=int)
+    parser.add_argument("-D", "--dictionary",
+                        help="dictionary file to preload the table with")
 
     args = parser.parse_args()
 
-    if (args.decompress):
-        lzw_decompress(args.input_file, args.output_file, args.nb, args.size)
+    if (args.train):
+        lzw_train_file(args.input_file, args.output_file, args.nb, args.size,
+                       args.binary, args.dictionary_size)
+    elif (args.decompress):
+        lzw_decompress(args.input_file, args.output_file, args.nb, args.size,
+                       args.binary, args.dictionary)
     else:
-        lzw_compress(args.input_file, args.output_file, args.nb, args.size)
+        lzw_compress(args.input_file, args.output_file, args.nb, args.size,
+                     args.binary, args.dictionary)
@@ -0,0 +1,42 @@
+import argparse
+import os
+import tempfile
+
+from compression_benchmark import measure
+
+def benchmark_lzw(input_file, nbs, n):
+    size = os.path.getsize(input_file) / 2**20
+    print('{:>4} {:>12} {:>10} {:>10} {:>12}'.format(
+        'nb', 'operation', 'MB/s', 'ratio', 'peak RSS MB'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compressed = os.path.join(tmp_dir, 'compressed')
+        decompressed = os.path.join(tmp_dir, 'decompressed')
+        for nb in nbs:
+            for function, output_file in [('lzw_compress', compressed),
+                                          ('lzw_decompress', decompressed)]:
+                source = input_file if function == 'lzw_compress' else \
+                    compressed
+                result = measure('lzw', function, source, output_file, nb, n)
+                ratio = os.path.getsize(input_file) / os.path.getsize(
+                    compressed)
+                print('{:>4} {:>12} {:>10.2f} {:>10.2f} {:>12.1f}'.format(
+                    nb, function[4:], size / result['seconds'], ratio,
+                    result['peak_rss_kb'] / 1024))
+            with open(input_file) as f1, open(decompressed) as f2:
+                if f1.read() != f2.read():
+                    raise RuntimeError('round trip failed for nb={}'.format(nb))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LZW benchmark")
+
+    parser.add_argument('input_file', nargs='?', help='Input file',
+                        default='ulysses.txt')
+    parser.add_argument("-n", "--nb", nargs='+',
+                        help="maximum numbers of bits to try",
+                        type=int, default=[16, 20])
+    parser.add_argument("-s", "--size", help="size of alphabet",
+                        type=int, default=2**8)
+
+    args = parser.parse_args()
+
+    benchmark_lzw(args.input_file, args.nb, args.size)
@@ -1,5 +1,24 @@
+import argparse
+import glob
+import io
+import math
+import os
+import random
 import time
 
+from array import array
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The layout of the arrays that load_quotes returns and caches.
+QUOTE_DTYPE = [('date', 'datetime64[D]'), ('quote', 'float64')]
+
 def simple_stock_span(quotes: list[float]) -> list[int]:
     spans = []
     for i in range(len(quotes)):
@@ -27,9 +46,177 @@ def stack_stock_span(quotes: list[float]) -> list[int]:
         s.append(i)
     return spans
 
-def read_quotes(filename: str) -> tuple[list[str], list[float]]:
-    dates = []
-    quotes = []
+class StockSpanner:
+    """Compute stock spans online, one quote at a time.
+
+    We keep only the stack of the quotes that have not been exceeded
+    yet, each with its span, instead of the whole history. Each quote
+    is pushed and popped at most once, so a quote takes amortized O(1)
+    time.
+    """
+
+    def __init__(self) -> None:
+        self.stack: list[tuple[float, int]] = []
+
+    def next(self, quote: float) -> int:
+        """Return the span of quote, the next quote in the series."""
+        span = 1
+        stack = self.stack
+        while len(stack) != 0 and stack[-1][0] <= quote:
+            span += stack.pop()[1]
+        stack.append((quote, span))
+        return span
+
+    def extend(self, quotes: Iterable[float]) -> list[int]:
+        """Return the spans of a batch of quotes."""
+        return [self.next(quote) for quote in quotes]
+
+def stream_stock_spans(quotes: Iterable[float]) -> Iterator[int]:
+    """Yield the span of each quote as it arrives."""
+    spanner = StockSpanner()
+    for quote in quotes:
+        yield spanner.next(quote)
+
+def stack_stock_span_into(quotes: Sequence[float], spans: memoryview,
+                          start: int, end: int) -> None:
+    """Write in spans[start:end] the spans of quotes[start:end]."""
+    s = []
+    for i in range(start, end):
+        quote = quotes[i]
+        while len(s) != 0 and quotes[s[-1]] <= quote:
+            s.pop()
+        if len(s) == 0:
+            spans[i] = i - start + 1
+        else:
+            spans[i] = i - s[-1]
+        s.append(i)
+
+def shared_spans_task(quotes_name: str, spans_name: str,
+                      bounds: list[tuple[int, int]]) -> None:
+    """Compute the spans of the series at bounds in shared memory."""
+    quotes_shm = shared_memory.SharedMemory(name=quotes_name)
+    spans_shm = shared_memory.SharedMemory(name=spans_name)
+    try:
+        quotes = quotes_shm.buf.cast('d')
+        spans = spans_shm.buf.cast('q')
+        for start, end in bounds:
+            stack_stock_span_into(quotes, spans, start, end)
+        quotes.release()
+        spans.release()
+    finally:
+        quotes_shm.close()
+        spans_shm.close()
+
+def multi_stock_spans(series: Sequence[Sequence[float]],
+                      workers: int | None = None,
+                      tasks_per_worker: int = 4) -> list[array]:
+    """Compute the spans of many series in parallel.
+
+    The series are copied once into a shared memory block, and the
+    workers write their spans into another one, so that neither quotes
+    nor spans are pickled between processes.
+
+    Parameters
+    ----------
+    series : sequence
+        the series, each a sequence of floats
+    workers : int
+        the number of worker processes, by default the number of CPUs
+    tasks_per_worker : int
+        the number of tasks to split the series into, per worker, to
+        balance the load when the series have different lengths
+
+    Returns
+    -------
+    spans : list
+        The spans of each series, as an array of integers
+    """
+    workers = workers or os.cpu_count()
+    bounds = []
+    total = 0
+    for quotes in series:
+        bounds.append((total, total + len(quotes)))
+        total += len(quotes)
+    # A shared memory block cannot be empty.
+    size = max(total, 1) * 8
+    quotes_shm = shared_memory.SharedMemory(create=True, size=size)
+    spans_shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shared_quotes = quotes_shm.buf.cast('d')
+        for (start, end), quotes in zip(bounds, series):
+            shared_quotes[start:end] = array('d', quotes)
+        shared_quotes.release()
+        # Split the series into tasks of about the same number of quotes.
+        task_size = max(total // (workers * tasks_per_worker), 1)
+        tasks = [[]]
+        task_quotes = 0
+        for start, end in bounds:
+            if task_quotes >= task_size:
+                tasks.append([])
+                task_quotes = 0
+            tasks[-1].append((start, end))
+            task_quotes += end - start
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(shared_spans_task, quotes_shm.name,
+                                       spans_shm.name, task)
+                       for task in tasks]
+            for future in futures:
+                future.result()
+        shared_spans = spans_shm.buf.cast('q')
+        spans = [array('q', shared_spans[start:end])
+                 for start, end in bounds]
+        shared_spans.release()
+        return spans
+    finally:
+        quotes_shm.close()
+        quotes_shm.unlink()
+        spans_shm.close()
+        spans_shm.unlink()
+
+class RangeMaxIndex:
+    """A sparse table over a series of quotes.
+
+    Level k of the table holds the maximum of each run of 2**k quotes,
+    so the maximum of any range is the larger of two overlapping runs.
+    The table takes O(n log n) time and space to build.
+    """
+
+    def __init__(self, quotes: Sequence[float]) -> None:
+        self.levels = [array('d', quotes)]
+        width = 1
+        while 2 * width <= len(quotes):
+            previous = self.levels[-1]
+            self.levels.append(array('d', map(max,
+                                              previous[:len(previous) - width],
+                                              previous[width:])))
+            width *= 2
+
+    def range_max(self, i: int, j: int) -> float:
+        """Return the maximum quote from i to j, inclusive, in O(1)."""
+        if not 0 <= i <= j < len(self.levels[0]):
+            raise IndexError('invalid range {}-{}'.format(i, j))
+        k = (j - i + 1).bit_length() - 1
+        level = self.levels[k]
+        return max(level[i], level[j - 2**k + 1])
+
+    def span(self, d: int, p: float) -> int:
+        """Return the number of consecutive quotes up to and including
+        d that are at most p, in O(log n).
+
+        The stock span at d is span(d, quotes[d]).
+        """
+        if not 0 <= d < len(self.levels[0]):
+            raise IndexError('invalid index {}'.format(d))
+        # We go back from d in runs of decreasing length, as long as
+        # each run has no quote above p.
+        start = d + 1
+        for k in range(len(self.levels) - 1, -1, -1):
+            if start - 2**k >= 0 and self.levels[k][start - 2**k] <= p:
+                start -= 2**k
+        return d + 1 - start
+
+def iter_quotes(filename: str) -> Iterator[tuple[str, float]]:
+    """Yield the date and the quote of each line of filename."""
     with open(filename) as quotes_file:
         for line in quotes_file:
             if line.startswith('#'):
@@ -39,16 +226,178 @@ def read_quotes(filename: str) -> tuple[list[str], list[float]]:
                 continue
             month, day, year = parts[0].split('/')
             date = '/'.join((year, month, day))
-            dates.append(date)
-            quotes.append(float(parts[-1]))
+            yield date, float(parts[-1])
+
+def read_quotes(filename: str) -> tuple[list[str], list[float]]:
+    dates = []
+    quotes = []
+    for date, quote in iter_quotes(filename):
+        dates.append(date)
+        quotes.append(quote)
     return dates, quotes
 
-_, quotes = read_quotes("djia.csv")  # we use _ for a variable that we
-# don't care to use
+def parse_quotes(filename: str) -> 'np.ndarray':
+    """Parse filename in bulk into an array of QUOTE_DTYPE.
+
+    We turn the dates into numeric fields, so that the whole file is
+    parsed by np.loadtxt instead of line by line in Python.
+    """
+    with open(filename) as quotes_file:
+        text = quotes_file.read().replace('/', ',')
+    fields = np.loadtxt(io.StringIO(text), delimiter=',', comments='#',
+                        ndmin=2)
+    quotes = np.empty(len(fields), dtype=QUOTE_DTYPE)
+    months = fields[:, 0].astype(np.int64) - 1
+    days = fields[:, 1].astype(np.int64) - 1
+    years = fields[:, 2].astype(np.int64) - 1970
+    quotes['date'] = (years.astype('datetime64[Y]').astype('datetime64[M]')
+                      + months.astype('timedelta64[M]')).astype(
+                          'datetime64[D]') + days.astype('timedelta64[D]')
+    quotes['quote'] = fields[:, 3]
+    return quotes
+
+def cache_filename(filename: str, cache_dir: str | None = None) -> str:
+    """Return the name of the cache of filename.
+
+    The name contains the modification time and the size of filename,
+    so that a changed file does not match an old cache.
+    """
+    stat = os.stat(filename)
+    directory, basename = os.path.split(os.path.abspath(filename))
+    if cache_dir is not None:
+        directory = cache_dir
+    return os.path.join(directory, '{}.{}-{}.npy'.format(
+        basename, stat.st_mtime_ns, stat.st_size))
+
+def load_quotes(filename: str, cache: bool = True,
+                cache_dir: str | None = None) -> tuple['np.ndarray',
+                                                       'np.ndarray']:
+    """Load the dates and the quotes of filename as NumPy arrays.
+
+    The parsed data are cached in a .npy file next to filename, which
+    .gitignore excludes, or in cache_dir, which is created if needed. Later loads map the cache into memory instead of parsing
+    filename again, so the returned arrays are read-only.
+
+    Returns
+    -------
+    dates, quotes : np.ndarray, np.ndarray
+        The dates, as datetime64[D], and the quotes, as float64
+    """
+    if np is None:
+        raise ImportError('load_quotes needs NumPy')
+    if not cache:
+        data = parse_quotes(filename)
+        return data['date'], data['quote']
+    cached = cache_filename(filename, cache_dir)
+    if not os.path.exists(cached):
+        data = parse_quotes(filename)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so that a concurrent load
+        # never sees a partial cache.
+        tmp_cached = '{}.{}.tmp'.format(cached, os.getpid())
+        with open(tmp_cached, 'wb') as cache_file:
+            np.save(cache_file, data)
+        os.replace(tmp_cached, cached)
+        stale = glob.glob(glob.escape(cached.rsplit('.', 2)[0]) + '.*-*.npy')
+        for stale_cache in stale:
+            if stale_cache != cached:
+                os.remove(stale_cache)
+    data = np.load(cached, mmap_mode='r')
+    return data['date'], data['quote']
+
+def trend_series(shape: str, n: int, seed: int = 42) -> array:
+    """Return a synthetic series of n quotes with the given shape.
+
+    An increasing series is the worst case for simple_stock_span, as
+    every quote has to look back to the start of the series.
+    """
+    rng = random.Random(seed)
+    if shape == 'increasing':
+        return array('d', range(n))
+    if shape == 'decreasing':
+        return array('d', range(n, 0, -1))
+    if shape == 'random':
+        return array('d', (rng.random() for _ in range(n)))
+    if shape == 'random_walk':
+        quotes = array('d', bytes(8 * n))
+        quote = 0.0
+        for i in range(n):
+            quote += rng.gauss(0, 1)
+            quotes[i] = quote
+        return quotes
+    raise ValueError('unknown shape {}'.format(shape))
+
+SHAPES = ['increasing', 'decreasing', 'random', 'random_walk']
+
+SPAN_METHODS = {
+    'simple': simple_stock_span,
+    'stack': stack_stock_span,
+    'spanner': lambda quotes: StockSpanner().extend(quotes),
+}
+
+def benchmark_spans(shapes: list[str], sizes: list[int],
+                    max_simple_size: int, seed: int) -> None:
+    """Time the span methods over synthetic series and print, for each
+    size, the slope of the log-log scaling curve since the previous
+    size: about 1 for linear and about 2 for quadratic time.
+    """
+    print('{:>12} {:>12} {:>8} {:>12} {:>6}'.format(
+        'shape', 'size', 'method', 'seconds', 'slope'))
+    for shape in shapes:
+        previous = {}
+        for size in sizes:
+            quotes = trend_series(shape, size, seed)
+            for name, method in SPAN_METHODS.items():
+                if name == 'simple' and size > max_simple_size:
+                    continue
+                start = time.perf_counter()
+                method(quotes)
+                elapsed = time.perf_counter() - start
+                slope = ''
+                if name in previous:
+                    previous_size, previous_elapsed = previous[name]
+                    slope = '{:.2f}'.format(
+                        math.log(elapsed / previous_elapsed)
+                        / math.log(size / previous_size))
+                previous[name] = (size, elapsed)
+                print('{:>12} {:>12} {:>8} {:>12.4f} {:>6}'.format(
+                    shape, size, name, elapsed, slope))
+
+def check_spans(filename: str) -> bool:
+    _, quotes = read_quotes(filename)
+    spans_simple = simple_stock_span(quotes)
+    spans_stack = stack_stock_span(quotes)
+    return spans_simple == spans_stack
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stock spans')
+    subparsers = parser.add_subparsers(dest='command', required=True)
 
+    check_parser = subparsers.add_parser(
+        'check', help='compare the span methods on a quotes file')
+    check_parser.add_argument('quotes_file', nargs='?', help='quotes file',
+                              default=os.path.join(
+                                  os.path.dirname(os.path.abspath(__file__)),
+                                  'djia.csv'))
 
-spans_simple = simple_stock_span(quotes)
+    benchmark_parser = subparsers.add_parser(
+        'benchmark', help='time the span methods on synthetic series')
+    benchmark_parser.add_argument('-s', '--sizes', nargs='+', type=int,
+                                  help='series lengths',
+                                  default=[10**3, 10**4, 10**5, 10**6])
+    benchmark_parser.add_argument('--shapes', nargs='+', choices=SHAPES,
+                                  help='series shapes', default=SHAPES)
+    benchmark_parser.add_argument('-m', '--max_simple_size', type=int,
+                                  help='longest series for simple_stock_span',
+                                  default=10**4)
+    benchmark_parser.add_argument('--seed', help='random seed', type=int,
+                                  default=42)
 
-spans_stack = stack_stock_span(quotes)
+    args = parser.parse_args()
 
-print('spans_simple == spans_stack:', spans_simple == spans_stack)
\ No newline at end of file
+    if args.command == 'check':
+        print('spans_simple == spans_stack:', check_spans(args.quotes_file))
+    else:
+        benchmark_spans(args.shapes, args.sizes, args.max_simple_size,
+                        args.seed)
@@ -10,11 +10,16 @@ Based on the pelican-cite plugin written by Chris MacMackin.
 
 """
 
+import hashlib
 import logging
+import os
+import pickle
 import re
 import sys
+import tempfile
 
 try:
+    import pybtex
     from pybtex.database.input.bibtex import Parser
     from pybtex.database.output.bibtex import Writer
     from pybtex.database import BibliographyData, PybtexError
@@ -43,6 +48,11 @@ class PlainStyle(UnsrtStyle):
 
 logger = logging.getLogger(__name__)
 global_bib = None
+
+# Parsed bibliographies, keyed by the absolute path, modification time and
+# size of their files, and the directory of the on-disk cache, if any
+bib_memo = {}
+bib_cache_dir = None
 if pyb_imported:
     style = PlainStyle()
     backend = html.Backend()
@@ -50,6 +60,65 @@ else:
     style = None
     backend = None
 
+def bib_cache_path(path):
+    # Bibliographies pickled by another version of pybtex may not load
+    key = '%s\0%s' % (path, pybtex.__version__)
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest() + '.pickle'
+    return os.path.join(bib_cache_dir, name)
+
+def load_cached_bib(path, stat):
+    """
+    Return the bibliography of path from the on-disk cache, if its file has
+    the same modification time and size, or the same contents, as when it
+    was cached; otherwise return the hash of the file, to cache it with.
+    """
+    try:
+        with open(bib_cache_path(path), 'rb') as cache_file:
+            mtime, size, digest, bib = pickle.load(cache_file)
+    except Exception:
+        # Unpickling can fail in many ways; any failure is a cache miss
+        mtime = size = digest = bib = None
+    if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+        return bib, digest
+    with open(path, 'rb') as bib_file:
+        new_digest = hashlib.sha256(bib_file.read()).hexdigest()
+    if new_digest == digest:
+        # Touched but not changed
+        save_cached_bib(path, stat, digest, bib)
+        return bib, digest
+    return None, new_digest
+
+def save_cached_bib(path, stat, digest, bib):
+    try:
+        os.makedirs(bib_cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=bib_cache_dir,
+                                         delete=False) as cache_file:
+            pickle.dump((stat.st_mtime_ns, stat.st_size, digest, bib),
+                        cache_file)
+        os.replace(cache_file.name, bib_cache_path(path))
+    except (OSError, pickle.PicklingError) as e:
+        logger.warn('`pelican_pcite` could not cache %s: %s' % (path, str(e)))
+
+def parse_bib_file(refs_file):
+    """
+    Parse a bibliography file, unless it has already been parsed in this
+    build or, unchanged, in an earlier one.
+    """
+    path = os.path.abspath(refs_file)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key in bib_memo:
+        return bib_memo[key]
+    bib = digest = None
+    if bib_cache_dir is not None:
+        bib, digest = load_cached_bib(path, stat)
+    if bib is None:
+        bib = Parser().parse_file(path)
+        if bib_cache_dir is not None:
+            save_cached_bib(path, stat, digest, bib)
+    bib_memo[key] = bib
+    return bib
+
 def get_bib_file(article):
     """
     If a bibliography file is specified for this article/page, parse
@@ -58,9 +127,9 @@ def get_bib_file(article):
     if 'publications_src' in article.metadata:
         refs_file = article.metadata['publications_src']
         try:
-            local_bib = Parser().parse_file(refs_file)
+            local_bib = parse_bib_file(refs_file)
             return local_bib
-        except PybtexError as e:
+        except (PybtexError, OSError) as e:
             logger.warn('`pelican_bibtex` failed to parse file %s: %s' % (
                 refs_file,
                 str(e)))
@@ -152,16 +221,22 @@ def process_content(article):
     
 
 def add_citations(generators):
-    global global_bib
+    global global_bib, bib_cache_dir
     if not pyb_imported:
         logger.warn('`pelican-cite` failed to load dependency `pybtex`')
         return
 
-    if 'PUBLICATIONS_SRC' in generators[0].settings:
-        refs_file = generators[0].settings['PUBLICATIONS_SRC']
+    settings = generators[0].settings
+    bib_cache_dir = None
+    if settings.get('PUBLICATIONS_CACHE', True):
+        bib_cache_dir = os.path.join(settings.get('CACHE_PATH', 'cache'),
+                                     'pelican_pcite')
+
+    if 'PUBLICATIONS_SRC' in settings:
+        refs_file = settings['PUBLICATIONS_SRC']
         try:
-            global_bib = Parser().parse_file(refs_file)
-        except PybtexError as e:
+            global_bib = parse_bib_file(refs_file)
+        except (PybtexError, OSError) as e:
             logger.warn('`pelican_bibtex` failed to parse file %s: %s' % (
                 refs_file,
                 str(e)))
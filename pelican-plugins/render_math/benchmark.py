@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Pelican Mathjax Markdown Extension
+===================================================
+Times the conversion of synthetic documents with thousands of formulas,
+and of the Markdown files of the site, with the extension. Run it from
+the plugins directory, as a module:
+
+    python -m render_math.benchmark
+"""
+
+import argparse
+import glob
+import math
+import os
+import random
+import time
+
+import markdown
+
+from .pelican_mathjax_markdown_extension import PelicanMathJaxExtension
+
+CONTENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', '..', 'content')
+
+def inline_paragraph(n, rng):
+    """One paragraph with n inlined formulas"""
+    return ' '.join('word $x_{%d} = %d$ and' % (i, rng.randrange(100))
+                    for i in range(n))
+
+def display_paragraphs(n, rng):
+    """n paragraphs, each with displayed math inside it"""
+    return '\n\n'.join('text $$y_{%d} = %d$$ more' % (i, rng.randrange(100))
+                       for i in range(n))
+
+def mixed(n, rng):
+    """Paragraphs with inlined math, displayed math, equations, code
+    spans and dollars that are not math"""
+    parts = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.6:
+            parts.append('Let $x_{%d} = a_%d^2$ be *some* value and '
+                         '`code $x$` here.' % (i, i))
+        elif r < 0.8:
+            parts.append('\n\n$$\n\\sum_{i=1}^{%d} i = \\frac{n(n+1)}{2}\n$$'
+                         '\n\n' % i)
+        elif r < 0.9:
+            parts.append('\n\n\\begin{equation}\nx_%d = 1\n'
+                         '\\end{equation}\n\n' % i)
+        else:
+            parts.append('\n\nThis costs $40 and that $50.\n\n')
+    return ' '.join(parts)
+
+DOCUMENTS = {
+    'inline': inline_paragraph,
+    'display': display_paragraphs,
+    'mixed': mixed,
+}
+
+def convert(text):
+    extension = PelicanMathJaxExtension({'mathjax_script': '',
+                                         'math_tag_class': 'math',
+                                         'auto_insert': True})
+    start = time.perf_counter()
+    markdown.markdown(text, extensions=[extension])
+    return time.perf_counter() - start
+
+def benchmark_synthetic(documents, sizes, seed):
+    """Time the conversion of synthetic documents and print, for each
+    size, the slope of the log-log scaling curve since the previous size:
+    about 1 for linear and about 2 for quadratic time"""
+    print('{:>10} {:>10} {:>10} {:>6}'.format(
+        'document', 'formulas', 'seconds', 'slope'))
+    for document in documents:
+        previous = None
+        for size in sizes:
+            elapsed = convert(DOCUMENTS[document](size, random.Random(seed)))
+            slope = ''
+            if previous is not None:
+                slope = '{:.2f}'.format(math.log(elapsed / previous[1])
+                                        / math.log(size / previous[0]))
+            previous = (size, elapsed)
+            print('{:>10} {:>10} {:>10.4f} {:>6}'.format(
+                document, size, elapsed, slope))
+
+def benchmark_files(filenames):
+    """Time the conversion of Markdown files"""
+    print('{:>50} {:>10}'.format('file', 'seconds'))
+    total = 0
+    for filename in filenames:
+        with open(filename) as markdown_file:
+            elapsed = convert(markdown_file.read())
+        total += elapsed
+        print('{:>50} {:>10.4f}'.format(os.path.basename(filename), elapsed))
+    print('{:>50} {:>10.4f}'.format('total', total))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+                                     'Benchmark the mathjax markdown extension')
+    parser.add_argument('files', nargs='*',
+                        help='Markdown files; by default, those of the site',
+                        default=sorted(glob.glob(
+                            os.path.join(CONTENT_DIR, '**', '*.md'),
+                            recursive=True)))
+    parser.add_argument('-s', '--sizes', nargs='+', type=int,
+                        default=[1000, 2000, 4000, 8000],
+                        help='numbers of formulas of synthetic documents')
+    parser.add_argument('-d', '--documents', nargs='+', choices=DOCUMENTS,
+                        default=list(DOCUMENTS),
+                        help='synthetic documents to convert')
+    parser.add_argument('--seed', help='random seed', type=int, default=42)
+    args = parser.parse_args()
+
+    benchmark_synthetic(args.documents, args.sizes, args.seed)
+    print()
+    benchmark_files(args.files)
@@ -30,20 +30,25 @@ template builders that want to adjust the look and feel of
 the math.  See README for more details.
 """
 
+import hashlib
+import html
+import itertools
 import os
+import pickle
+import re
 import sys
 
 from pelican import signals, generators
 
 try:
-    from bs4 import BeautifulSoup
+    from . pelican_mathjax_markdown_extension import PelicanMathJaxExtension
 except ImportError as e:
-    BeautifulSoup = None
+    PelicanMathJaxExtension = None
 
 try:
-    from . pelican_mathjax_markdown_extension import PelicanMathJaxExtension
+    from . prerender import MathPrerenderer
 except ImportError as e:
-    PelicanMathJaxExtension = None
+    MathPrerenderer = None
 
 def process_settings(pelicanobj):
     """Sets user specified MathJax settings (see README for more details)"""
@@ -68,7 +73,11 @@ def process_settings(pelicanobj):
     mathjax_settings['responsive'] = 'false'  # Tries to make displayed math responsive
     mathjax_settings['responsive_break'] = '768'  # The break point at which it math is responsively aligned (in pixels)
     mathjax_settings['mathjax_font'] = 'default'  # forces mathjax to use the specified font.
-    mathjax_settings['process_summary'] = BeautifulSoup is not None  # will fix up summaries if math is cut off. Requires beautiful soup
+    mathjax_settings['process_summary'] = True  # will fix up summaries if math is cut off
+    mathjax_settings['summary_cache'] = True  # keeps fixed up summaries in CACHE_PATH, so that unchanged articles are not processed again
+    mathjax_settings['prerender'] = False  # renders math to SVG at build time, leaving to MathJax only what cannot be rendered. Requires matplotlib
+    mathjax_settings['prerender_fontset'] = 'cm'  # the mathtext font set used for prerendered math (values can be: cm, stix, stixsans, dejavusans, dejavuserif)
+    mathjax_settings['external_script'] = True  # writes the mathjax script to a file of the output, referenced by the pages with math, instead of inlining it in each of them
     mathjax_settings['message_style'] = 'normal'  # This value controls the verbosity of the messages in the lower left-hand corner. Set it to "none" to eliminate all messages
 
     # Source for MathJax
@@ -147,12 +156,25 @@ def process_settings(pelicanobj):
             mathjax_settings[key] = 'true' if value else 'false'
 
         if key == 'process_summary' and isinstance(value, bool):
-            if value and BeautifulSoup is None:
-                print("BeautifulSoup4 is needed for summaries to be processed by render_math\nPlease install it")
+            mathjax_settings[key] = value
+
+        if key == 'summary_cache' and isinstance(value, bool):
+            mathjax_settings[key] = value
+
+        if key == 'prerender' and isinstance(value, bool):
+            if value and MathPrerenderer is None:
+                print("matplotlib is needed for math to be prerendered by render_math\nPlease install it")
                 value = False
 
             mathjax_settings[key] = value
 
+        if key == 'prerender_fontset':
+            if value in ('cm', 'stix', 'stixsans', 'dejavusans', 'dejavuserif'):
+                mathjax_settings[key] = value
+
+        if key == 'external_script' and isinstance(value, bool):
+            mathjax_settings[key] = value
+
         if key == 'responsive' and isinstance(value, bool):
             mathjax_settings[key] = 'true' if value else 'false'
 
@@ -193,23 +215,126 @@ def process_settings(pelicanobj):
 
     return mathjax_settings
 
+# Matches the elements whose class is math; their contents are in the
+# group math. Math elements do not nest, so the first closing tag of the
+# same name ends the element.
+MATH_ELEMENT = re.compile(
+    r"""<(?P<tag>span|div)\b[^>]*?\bclass=(?P<quote>["'])"""
+    r"""(?:[^"']*\s)?math(?:\s[^"']*)?(?P=quote)[^>]*>"""
+    r"""(?P<math>.*?)</(?P=tag)>""", re.DOTALL)
+
+TAG = re.compile(r'<[^>]*>')
+
+SUMMARY_CACHE_FILE = 'render_math_summaries.pickle'
+
+# Where the mathjax script is written in the output, if it is not
+# inlined, under the THEME_STATIC_DIR of the site
+SCRIPT_DIR = 'js'
+
+def fix_summary(summary, content):
+    """Completes the last formula of summary if it was cut off, taking it
+    from content. Returns the summary and whether it contains math"""
+
+    math = list(MATH_ELEMENT.finditer(summary))
+
+    if len(math) == 0:
+        return summary, False
+
+    last_math_text = html.unescape(TAG.sub('', math[-1].group('math')))
+    if len(last_math_text) > 3 and last_math_text[-3:] == '...':
+        # We only need to scan content up to the formula that was cut off
+        full_math = next(itertools.islice(MATH_ELEMENT.finditer(content),
+                                          len(math) - 1, None), None)
+        if full_math is not None:
+            summary = "%s%s ...%s" % (summary[:math[-1].start('math')],
+                                      full_math.group('math'),
+                                      summary[math[-1].end('math'):])
+
+    return summary, True
+
 def process_summary(article):
     """Ensures summaries are not cut off. Also inserts
     mathjax script so that math will be rendered"""
 
     summary = article._get_summary()
-    summary_parsed = BeautifulSoup(summary, 'html.parser')
-    math = summary_parsed.find_all(class_='math')
 
-    if len(math) > 0:
-        last_math_text = math[-1].get_text()
-        if len(last_math_text) > 3 and last_math_text[-3:] == '...':
-            content_parsed = BeautifulSoup(article._content, 'html.parser')
-            full_text = content_parsed.find_all(class_='math')[len(math)-1].get_text()
-            math[-1].string = "%s ..." % full_text
-            summary = summary_parsed.decode()
+    if process_summary.cache is None:
+        summary, has_math = fix_summary(summary, article._content)
+    else:
+        key = hashlib.sha256(
+            ('%s\0%s' % (summary, article._content)).encode('utf-8')).hexdigest()
+        if key not in process_summary.cache:
+            process_summary.cache[key] = fix_summary(summary, article._content)
+        summary, has_math = process_summary.cache[key]
+        process_summary.cache_hits[key] = (summary, has_math)
+
+    if has_math and prerender_html.renderer is not None:
+        summary, left = prerender_html(summary)
+        article._summary = summary
+        has_math = left > 0 and prerender_math.auto_insert
+
+    if has_math:
+        article._summary = "%s%s" % (summary, process_summary.mathjax_tag)
 
-        article._summary = "%s<script type='text/javascript'>%s</script>" % (summary, process_summary.mathjax_script)
+def summary_cache_path(pelicanobj):
+    return os.path.join(pelicanobj.settings.get('CACHE_PATH', 'cache'),
+                        SUMMARY_CACHE_FILE)
+
+def load_summary_cache(pelicanobj):
+    """Loads the summaries fixed up in earlier builds"""
+
+    try:
+        with open(summary_cache_path(pelicanobj), 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+def save_summary_cache(pelicanobj):
+    """Saves the summaries used in this build, so that stale entries do
+    not accumulate"""
+
+    if process_summary.cache is None:
+        return
+
+    cache_path = summary_cache_path(pelicanobj)
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with open(cache_path, 'wb') as cache_file:
+            pickle.dump(process_summary.cache_hits, cache_file)
+    except OSError as e:
+        sys.stderr.write("\nrender_math could not save its summary cache: %s\n" % e)
+
+def prerender_html(text):
+    """Replaces the formulas of text that can be rendered at build time
+    with SVG. Returns the text and the number of formulas left for MathJax"""
+
+    # The glyphs defined so far in text, with ids prefixed by a hash of
+    # text, as several texts may be shown in one page
+    defined = set()
+    prefix = 'math-' + hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]
+    left = 0
+
+    def replace(match):
+        nonlocal left
+        svg = prerender_html.renderer.svg(match.group('math'),
+                                          match.group('tag') == 'div', defined,
+                                          prefix)
+        if svg is None:
+            left += 1
+            return match.group(0)
+        start = match.start()
+        return "%s%s%s" % (match.group(0)[:match.start('math') - start], svg,
+                           match.group(0)[match.end('math') - start:])
+
+    return MATH_ELEMENT.sub(replace, text), left
+
+def prerender_math(content):
+    """Prerenders the math of content, adding the mathjax script only if
+    some formulas could not be rendered"""
+
+    content._content, left = prerender_html(content._content)
+    if left > 0 and prerender_math.auto_insert:
+        content._content += prerender_math.mathjax_tag
 
 def configure_typogrify(pelicanobj, mathjax_settings):
     """Instructs Typogrify to ignore math tags - which allows Typogrify
@@ -253,15 +378,64 @@ def process_mathjax_script(mathjax_settings):
 
     return mathjax_template.format(**mathjax_settings)
 
-def mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings):
+def mathjax_script_tag(mathjax_script, script_url):
+    """Returns the html that runs the mathjax script: a deferred reference
+    to script_url, if given, or else the script itself"""
+
+    if script_url:
+        return '<script defer src="%s" type="text/javascript"></script>' % script_url
+
+    return "<script type='text/javascript'>%s</script>" % mathjax_script
+
+def write_mathjax_script(pelicanobj):
+    """Writes the mathjax script to the output, if it is not inlined. The
+    name of the file has the hash of the script, so that browsers can cache
+    it for as long as it stays the same"""
+
+    if write_mathjax_script.path is None:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(write_mathjax_script.path), exist_ok=True)
+        with open(write_mathjax_script.path, 'w', encoding='utf-8') as script_file:
+            script_file.write(write_mathjax_script.script)
+    except OSError as e:
+        sys.stderr.write("\nrender_math could not write the mathjax script: %s\n" % e)
+
+def dedupe_mathjax_tags(path, context):
+    """Keeps only the first reference to the mathjax script in a written
+    page, such as an index page with many summaries with math"""
+
+    if dedupe_mathjax_tags.pattern is None or not path.endswith('.html'):
+        return
+
+    with open(path, encoding='utf-8') as page_file:
+        page = page_file.read()
+
+    first = dedupe_mathjax_tags.pattern.search(page)
+    if first is None:
+        return
+
+    rest = dedupe_mathjax_tags.pattern.sub('', page[first.end():])
+    if len(rest) == len(page) - first.end():
+        return
+
+    with open(path, 'w', encoding='utf-8') as page_file:
+        page_file.write(page[:first.end()] + rest)
+
+def mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings, script_url):
     """Instantiates a customized markdown extension for handling mathjax
     related content"""
 
     # Create the configuration for the markdown template
     config = {}
     config['mathjax_script'] = mathjax_script
+    config['mathjax_src'] = script_url or ''
     config['math_tag_class'] = 'math'
-    config['auto_insert'] = mathjax_settings['auto_insert']
+    # When math is prerendered, the script is added after prerendering, and
+    # only if needed
+    config['auto_insert'] = (mathjax_settings['auto_insert'] and
+                             not mathjax_settings['prerender'])
 
     # Instantiate markdown extension and append it to the current extensions
     try:
@@ -274,12 +448,12 @@ def mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings):
         sys.stderr.write("\nError - the pelican mathjax markdown extension failed to configure. MathJax is non-functional.\n")
         sys.stderr.flush()
 
-def mathjax_for_rst(pelicanobj, mathjax_script):
+def mathjax_for_rst(pelicanobj, mathjax_tag):
     """Setup math for RST"""
     docutils_settings = pelicanobj.settings.get('DOCUTILS_SETTINGS', {})
     docutils_settings['math_output'] = 'MathJax'
     pelicanobj.settings['DOCUTILS_SETTINGS'] = docutils_settings
-    rst_add_mathjax.mathjax_script = mathjax_script
+    rst_add_mathjax.mathjax_tag = mathjax_tag
 
 def pelican_init(pelicanobj):
     """
@@ -294,33 +468,75 @@ def pelican_init(pelicanobj):
     # Generate mathjax script
     mathjax_script = process_mathjax_script(mathjax_settings)
 
+    # Unless it is inlined, the script goes to a file named after its hash,
+    # referenced from the pages like the assets of the theme
+    script_url = None
+    write_mathjax_script.path = None
+    dedupe_mathjax_tags.pattern = None
+    if mathjax_settings['external_script']:
+        script_name = 'render_math-%s.js' % hashlib.sha256(
+            mathjax_script.encode('utf-8')).hexdigest()[:16]
+        script_dir = '/'.join(part for part in (
+            pelicanobj.settings.get('THEME_STATIC_DIR', 'theme').strip('/'),
+            SCRIPT_DIR) if part)
+        write_mathjax_script.path = os.path.join(
+            pelicanobj.settings.get('OUTPUT_PATH', 'output'),
+            *(script_dir.split('/') + [script_name]))
+        write_mathjax_script.script = mathjax_script
+        script_url = '%s/%s/%s' % (pelicanobj.settings.get('SITEURL', ''),
+                                   script_dir, script_name)
+        dedupe_mathjax_tags.pattern = re.compile(
+            r"""<script\b[^>]*\bsrc=["']%s["'][^>]*>\s*</script>"""
+            % re.escape(script_url))
+    mathjax_tag = mathjax_script_tag(mathjax_script, script_url)
+
     # Configure Typogrify
     configure_typogrify(pelicanobj, mathjax_settings)
 
     # Configure Mathjax For Markdown
     if PelicanMathJaxExtension:
-        mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings)
+        mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings, script_url)
 
     # Configure Mathjax For RST
-    mathjax_for_rst(pelicanobj, mathjax_script)
-
-    # Set process_summary's mathjax_script variable
-    process_summary.mathjax_script = None
+    mathjax_for_rst(pelicanobj, mathjax_tag)
+
+    # Set up prerendering; the mathjax script is then added by prerender_math
+    prerender_html.renderer = None
+    if mathjax_settings['prerender']:
+        prerender_html.renderer = MathPrerenderer(
+            os.path.join(pelicanobj.settings.get('CACHE_PATH', 'cache'),
+                         'render_math'),
+            mathjax_settings['prerender_fontset'],
+            mathjax_settings['color'], mathjax_settings['align'],
+            mathjax_settings['indent'])
+        prerender_math.mathjax_tag = mathjax_tag
+        prerender_math.auto_insert = mathjax_settings['auto_insert']
+        rst_add_mathjax.mathjax_tag = None
+
+    # Set process_summary's mathjax_tag variable
+    process_summary.mathjax_tag = None
     if mathjax_settings['process_summary']:
-        process_summary.mathjax_script = mathjax_script
+        process_summary.mathjax_tag = mathjax_tag
+
+    # Load the summaries of earlier builds; cache_hits collects the
+    # summaries used in this build
+    process_summary.cache = None
+    process_summary.cache_hits = {}
+    if mathjax_settings['process_summary'] and mathjax_settings['summary_cache']:
+        process_summary.cache = load_summary_cache(pelicanobj)
 
 def rst_add_mathjax(content):
     """Adds mathjax script for reStructuredText"""
 
     # .rst is the only valid extension for reStructuredText files
     _, ext = os.path.splitext(os.path.basename(content.source_path))
-    if ext != '.rst':
+    if ext != '.rst' or rst_add_mathjax.mathjax_tag is None:
         return
 
     # If math class is present in text, add the javascript
     # note that RST hardwires mathjax to be class "math"
     if 'class="math"' in content._content:
-        content._content += "<script type='text/javascript'>%s</script>" % rst_add_mathjax.mathjax_script
+        content._content += rst_add_mathjax.mathjax_tag
 
 def process_rst_and_summaries(content_generators):
     """
@@ -346,13 +562,21 @@ def process_rst_and_summaries(content_generators):
                     generator.drafts):
                 rst_add_mathjax(article)
                 #optionally fix truncated formulae in summaries.
-                if process_summary.mathjax_script is not None:
+                if process_summary.mathjax_tag is not None:
                     process_summary(article)
+                # Prerender after the summary is taken from the content
+                if prerender_html.renderer is not None:
+                    prerender_math(article)
         elif isinstance(generator, generators.PagesGenerator):
             for page in generator.pages:
                 rst_add_mathjax(page)
+                if prerender_html.renderer is not None:
+                    prerender_math(page)
 
 def register():
     """Plugin registration"""
     signals.initialized.connect(pelican_init)
     signals.all_generators_finalized.connect(process_rst_and_summaries)
+    signals.finalized.connect(save_summary_cache)
+    signals.finalized.connect(write_mathjax_script)
+    signals.content_written.connect(dedupe_mathjax_tags)
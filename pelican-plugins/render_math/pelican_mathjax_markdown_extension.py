@@ -8,90 +8,253 @@ gives Pelican the ability to use Mathjax as a "first class
 citizen" of the blog
 """
 
+import re
+
 import markdown
 
 from markdown.util import etree
 from markdown.util import AtomicString
 
-class PelicanMathJaxPattern(markdown.inlinepatterns.Pattern):
-    """Inline markdown processing that matches mathjax"""
+# Math is replaced by these placeholders before inline patterns are
+# applied, and put back afterwards
+MATH_PLACEHOLDER = markdown.util.STX + 'mathjax:%d' + markdown.util.ETX
+MATH_PLACEHOLDER_RE = re.compile(markdown.util.STX + r'mathjax:(\d+)' + markdown.util.ETX)
+
+# The characters that may start math, a code span, an inline html tag or
+# an escape
+SPECIAL_RE = re.compile(r'[$`<\\]')
+BACKTICKS_RE = re.compile(r'`+')
+BACKSLASHES_RE = re.compile(r'\\+')
+HTML_TAG_RE = re.compile(r'<(?:[A-Za-z/][^>]*|!--.*?--)>', re.DOTALL)
+BEGIN_RE = re.compile(r'\\begin\{([^{}]+)\}')
+
+def find_math(text):
+    """Finds the math of text in one scan. Yields (start, end, tag, math)
+    tuples, where tag is 'div' for displayed math and 'span' for inlined
+    math, and math is the text to put in the tag.
+
+    Inlined math is between single dollars, and the closing dollar must not
+    follow whitespace. Displayed math is between $$ and $$ or between
+    \\begin{...} and the matching \\end{...}. Code spans, inline html tags
+    and escaped characters are skipped.
+
+    Searches for closing delimiters remember where they stopped, so no
+    part of text is searched twice for the same delimiter."""
+
+    # The last position found for each closing delimiter, -1 if there is
+    # none after the position the search started from
+    found = {}
+
+    def find(delimiter, search, start):
+        position = found.get(delimiter)
+        if position is None or -1 < position < start:
+            position = search(start)
+            found[delimiter] = position
+        return position
+
+    def find_string(string):
+        return lambda start: text.find(string, start)
+
+    def find_code_end(backticks):
+        code_end = re.compile(r'(?<!`)%s(?!`)' % backticks)
+        def search(start):
+            m = code_end.search(text, start)
+            return m.start() if m else -1
+        return search
+
+    def escaped(position):
+        # A character is escaped by an odd number of backslashes
+        backslashes = 0
+        while (backslashes < position and
+               text[position - backslashes - 1] == '\\'):
+            backslashes += 1
+        return backslashes % 2 == 1
+
+    def find_inline_end(start):
+        position = text.find('$', start)
+        while position != -1 and (text[position - 1].isspace() or
+                                  escaped(position)):
+            position = text.find('$', position + 1)
+        return position
+
+    i = 0
+    while True:
+        m = SPECIAL_RE.search(text, i)
+        if m is None:
+            return
+        i = m.start()
+
+        if text[i] == '`':
+            backticks = BACKTICKS_RE.match(text, i).group()
+            end = find(backticks, find_code_end(backticks), i + len(backticks))
+            i = end + len(backticks) if end != -1 else i + len(backticks)
+
+        elif text[i] == '<':
+            tag = HTML_TAG_RE.match(text, i)
+            i = tag.end() if tag else i + 1
+
+        elif text[i] == '\\':
+            # Pairs of backslashes are literal backslashes; an odd one
+            # escapes the next character
+            i = BACKSLASHES_RE.match(text, i).end() - 1
+            if (i - m.start()) % 2 == 1:
+                i += 1
+                continue
+            begin = BEGIN_RE.match(text, i)
+            if begin is None:
+                i += 2  # an escaped character
+                continue
+            suffix = '\\end{%s}' % begin.group(1)
+            end = find(suffix, find_string(suffix), begin.end() + 1)
+            if end == -1:
+                i = begin.end()
+                continue
+            yield i, end + len(suffix), 'div', text[i:end + len(suffix)]
+            i = end + len(suffix)
+
+        elif text.startswith('$$', i):
+            end = find('$$', find_string('$$'), i + 3)
+            if end == -1:
+                i += 2
+                continue
+            yield i, end + 2, 'div', text[i:end + 2]
+            i = end + 2
+
+        else:
+            end = find('$', find_inline_end, i + 2)
+            if end == -1:
+                i += 1
+                continue
+            yield i, end + 1, 'span', '\\(%s\\)' % text[i + 1:end]
+            i = end + 1
+
+class PelicanMathJaxTokenizer(markdown.treeprocessors.Treeprocessor):
+    """Replaces math with placeholders before inline patterns are applied,
+    so that markdown leaves the math alone"""
 
-    def __init__(self, pelican_mathjax_extension, tag, pattern):
-        super(PelicanMathJaxPattern,self).__init__(pattern)
-        self.math_tag_class = pelican_mathjax_extension.getConfig('math_tag_class')
+    def __init__(self, pelican_mathjax_extension):
         self.pelican_mathjax_extension = pelican_mathjax_extension
-        self.tag = tag
 
-    def handleMatch(self, m):
-        node = markdown.util.etree.Element(self.tag)
-        node.set('class', self.math_tag_class)
+    def tokenize(self, text):
+        if not text or isinstance(text, AtomicString):
+            return text
 
-        prefix = '\\(' if m.group('prefix') == '$' else m.group('prefix')
-        suffix = '\\)' if m.group('suffix') == '$' else m.group('suffix')
-        node.text = markdown.util.AtomicString(prefix + m.group('math') + suffix)
+        math = self.pelican_mathjax_extension.math
+        parts = []
+        last = 0
+        for start, end, tag, contents in find_math(text):
+            parts.append(text[last:start])
+            parts.append(MATH_PLACEHOLDER % len(math))
+            math.append((tag, contents))
+            last = end
 
-        # If mathjax was successfully matched, then JavaScript needs to be added
-        # for rendering. The boolean below indicates this
-        self.pelican_mathjax_extension.mathjax_needed = True
-        return node
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    def run(self, root):
+        self.pelican_mathjax_extension.math = []
+        for element in root.iter():
+            element.text = self.tokenize(element.text)
+            element.tail = self.tokenize(element.tail)
+
+        # If mathjax was found, then JavaScript needs to be added for
+        # rendering. The boolean below indicates this
+        if self.pelican_mathjax_extension.math:
+            self.pelican_mathjax_extension.mathjax_needed = True
+        return root
 
 class PelicanMathJaxCorrectDisplayMath(markdown.treeprocessors.Treeprocessor):
-    """Corrects invalid html that results from a <div> being put inside
-    a <p> for displayed math"""
+    """Puts the math back in place of the placeholders, and corrects the
+    invalid html that results from a <div> being put inside a <p> for
+    displayed math"""
 
     def __init__(self, pelican_mathjax_extension):
         self.pelican_mathjax_extension = pelican_mathjax_extension
 
-    def correct_html(self, root, children, div_math, insert_idx, text):
-        """Separates out <div class="math"> from the parent tag <p>. Anything
-        in between is put into its own parent tag of <p>"""
+    def math_element(self, index):
+        tag, text = self.pelican_mathjax_extension.math[index]
+        node = markdown.util.etree.Element(tag)
+        node.set('class', self.math_tag_class)
+        node.text = AtomicString(text)
+        return node
 
-        current_idx = 0
+    def expand(self, text, children):
+        """Appends the math of text to children, each with the text that
+        follows it as its tail. Returns the text before the first math"""
 
-        for idx in div_math:
-            el = markdown.util.etree.Element('p')
-            el.text = text
-            el.extend(children[current_idx:idx])
+        if not text or markdown.util.STX not in text:
+            return text
 
-            # Test to ensure that empty <p> is not inserted  
-            if len(el) != 0 or (el.text and not el.text.isspace()):
-               root.insert(insert_idx, el)
-               insert_idx += 1
+        parts = MATH_PLACEHOLDER_RE.split(text)
+        for index, tail in zip(parts[1::2], parts[2::2]):
+            node = self.math_element(int(index))
+            node.tail = tail or None
+            children.append(node)
+        return parts[0] or None
 
-            text = children[idx].tail
-            children[idx].tail = None
-            root.insert(insert_idx, children[idx])
-            insert_idx += 1
-            current_idx = idx+1
+    def is_displayed_math(self, element):
+        return element.tag == 'div' and element.get('class') == self.math_tag_class
 
-        el = markdown.util.etree.Element('p')
-        el.text = text
-        el.extend(children[current_idx:])
+    def correct_html(self, paragraph):
+        """Separates out <div class="math"> from the parent tag <p>. Anything
+        in between is put into its own parent tag of <p>"""
 
-        if len(el) != 0 or (el.text and not el.text.isspace()):
-            root.insert(insert_idx, el)
+        elements = []
+        el = markdown.util.etree.Element('p')
+        el.text = paragraph.text
 
-    def run(self, root):
-        """Searches for <div class="math"> that are children in <p> tags and corrects
-        the invalid HTML that results"""
+        for child in paragraph:
+            if not self.is_displayed_math(child):
+                el.append(child)
+                continue
 
-        math_tag_class = self.pelican_mathjax_extension.getConfig('math_tag_class')
+            # Test to ensure that empty <p> is not inserted
+            if len(el) != 0 or (el.text and not el.text.isspace()):
+                elements.append(el)
 
-        for parent in root:
-            div_math = []
-            children = list(parent)
+            el = markdown.util.etree.Element('p')
+            el.text = child.tail
+            child.tail = None
+            elements.append(child)
 
-            for div in parent.findall('div'):
-                if div.get('class') == math_tag_class:
-                    div_math.append(children.index(div))
+        if len(el) != 0 or (el.text and not el.text.isspace()):
+            elements.append(el)
+
+        return elements
+
+    def process(self, element):
+        """Puts back the math of element and its descendants, then moves
+        displayed math out of the paragraphs among its children"""
+
+        for key, value in element.items():
+            if markdown.util.STX in value:
+                element.set(key, MATH_PLACEHOLDER_RE.sub(
+                    lambda m: self.pelican_mathjax_extension.math[int(m.group(1))][1],
+                    value))
+
+        children = []
+        element.text = self.expand(element.text, children)
+        for child in list(element):
+            self.process(child)
+            children.append(child)
+            child.tail = self.expand(child.tail, children)
+
+        corrected = []
+        for child in children:
+            if child.tag == 'p' and any(self.is_displayed_math(c) for c in child):
+                corrected.extend(self.correct_html(child))
+            else:
+                corrected.append(child)
+        element[:] = corrected
 
-            # Do not process further if no displayed math has been found
-            if not div_math:
-                continue
+    def run(self, root):
+        """Expands the placeholders in one pass over the tree"""
 
-            insert_idx = list(root).index(parent)
-            self.correct_html(root, children, div_math, insert_idx, parent.text) 
-            root.remove(parent)  # Parent must be removed last for correct insertion index
+        if self.pelican_mathjax_extension.math:
+            self.math_tag_class = self.pelican_mathjax_extension.getConfig('math_tag_class')
+            self.process(root)
 
         return root
 
@@ -109,7 +272,13 @@ class PelicanMathJaxAddJavaScript(markdown.treeprocessors.Treeprocessor):
         # Add the mathjax script to the html document
         mathjax_script = etree.Element('script')
         mathjax_script.set('type','text/javascript')
-        mathjax_script.text = AtomicString(self.pelican_mathjax_extension.getConfig('mathjax_script'))
+        mathjax_src = self.pelican_mathjax_extension.getConfig('mathjax_src')
+        if mathjax_src:
+            # The script is loaded from a file, after the page is parsed
+            mathjax_script.set('src', mathjax_src)
+            mathjax_script.set('defer', 'defer')
+        else:
+            mathjax_script.text = AtomicString(self.pelican_mathjax_extension.getConfig('mathjax_script'))
         root.append(mathjax_script)
 
         # Reset the boolean switch to false so that script is only added
@@ -124,12 +293,14 @@ class PelicanMathJaxExtension(markdown.Extension):
         try:
             # Needed for markdown versions >= 2.5
             self.config['mathjax_script'] = ['', 'Mathjax JavaScript script']
+            self.config['mathjax_src'] = ['', 'URL of the Mathjax JavaScript script, if it is not inlined']
             self.config['math_tag_class'] = ['math', 'The class of the tag in which mathematics is wrapped']
             self.config['auto_insert'] = [True, 'Determines if mathjax script is automatically inserted into content']
             super(PelicanMathJaxExtension,self).__init__(**config)
         except AttributeError:
             # Markdown versions < 2.5
             config['mathjax_script'] = [config['mathjax_script'], 'Mathjax JavaScript script']
+            config['mathjax_src'] = [config.get('mathjax_src', ''), 'URL of the Mathjax JavaScript script, if it is not inlined']
             config['math_tag_class'] = [config['math_tag_class'], 'The class of the tag in which mathematic is wrapped']
             config['auto_insert'] = [config['auto_insert'], 'Determines if mathjax script is automatically inserted into content']
             super(PelicanMathJaxExtension,self).__init__(config)
@@ -138,18 +309,15 @@ class PelicanMathJaxExtension(markdown.Extension):
         # needs to be injected into a document
         self.mathjax_needed = False
 
-    def extendMarkdown(self, md, md_globals):
-        # Regex to detect mathjax
-        mathjax_inline_regex = r'(?P<prefix>\$)(?P<math>.+?)(?P<suffix>(?<!\s)\2)'
-        mathjax_display_regex = r'(?P<prefix>\$\$|\\begin\{(.+?)\})(?P<math>.+?)(?P<suffix>\2|\\end\{\3\})'
-
-        # Process mathjax before escapes are processed since escape processing will
-        # intefer with mathjax. The order in which the displayed and inlined math
-        # is registered below matters
-        md.inlinePatterns.add('mathjax_displayed', PelicanMathJaxPattern(self, 'div', mathjax_display_regex), '<escape')
-        md.inlinePatterns.add('mathjax_inlined', PelicanMathJaxPattern(self, 'span', mathjax_inline_regex), '<escape')
+        # The math of the document being converted, as (tag, text) pairs
+        self.math = []
 
-        # Correct the invalid HTML that results from teh displayed math (<div> tag within a <p> tag) 
+    def extendMarkdown(self, md, md_globals):
+        # Replace math with placeholders before inline patterns are applied,
+        # since they would intefer with mathjax, and put it back afterwards.
+        # Putting it back also corrects the invalid HTML that results from
+        # the displayed math (<div> tag within a <p> tag)
+        md.treeprocessors.add('mathjax_tokenize', PelicanMathJaxTokenizer(self), '<inline')
         md.treeprocessors.add('mathjax_correctdisplayedmath', PelicanMathJaxCorrectDisplayMath(self), '>inline')
 
         # If necessary, add the JavaScript Mathjax library to the document. This must
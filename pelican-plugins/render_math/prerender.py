@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Math Prerendering for Pelican
+=============================
+Renders TeX to inline SVG at build time with the mathtext engine of
+matplotlib, so that pages whose math can all be rendered do not need
+MathJax. Mathtext supports a subset of TeX; formulas it cannot render
+are left for MathJax.
+
+The layout of each formula is kept in an on-disk cache, in a file named
+after a hash of the formula and the settings that affect its layout, so
+that rebuilds only render new formulas.
+"""
+
+import hashlib
+import html
+import os
+import pickle
+import re
+import tempfile
+
+import matplotlib
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path
+from matplotlib.textpath import TextToPath
+
+# Change this when the cached layouts change, to ignore older ones
+CACHE_VERSION = 1
+
+# The delimiters of the formulas we render. Numbered environments, and
+# any others, are left for MathJax, since they may be referred to.
+DELIMITERS = [('\\(', '\\)'), ('$$', '$$'), ('\\[', '\\]'),
+              ('\\begin{equation*}', '\\end{equation*}')]
+
+# An unescaped dollar would end the math in mathtext
+DOLLAR = re.compile(r'(?<!\\)\$')
+
+PATH_COMMANDS = {Path.MOVETO: 'M', Path.LINETO: 'L', Path.CURVE3: 'Q',
+                 Path.CURVE4: 'C', Path.CLOSEPOLY: 'Z'}
+
+def number(value):
+    """Formats a coordinate, to a tenth of a unit"""
+
+    # Adding 0.0 turns -0.0 to 0.0
+    return '%g' % (round(value, 1) + 0.0)
+
+def path_data(vertices, codes):
+    """Converts a matplotlib path to SVG path data, flipping the y axis"""
+
+    commands = []
+    for points, code in Path(vertices, codes).iter_segments(simplify=False,
+                                                            curves=True):
+        coordinates = ['%s %s' % (number(x), number(-y))
+                       for x, y in zip(points[::2], points[1::2])]
+        if code == Path.CLOSEPOLY:
+            coordinates = []
+        commands.append(PATH_COMMANDS[code] + ' '.join(coordinates))
+    return ''.join(commands)
+
+def tex_formula(math):
+    """Returns the TeX inside the delimiters of the contents of a math
+    element, or None if we do not render it"""
+
+    if '<' in math:
+        return None
+    math = html.unescape(math).strip()
+    for prefix, suffix in DELIMITERS:
+        if (len(math) >= len(prefix) + len(suffix) and
+                math.startswith(prefix) and math.endswith(suffix)):
+            tex = ' '.join(math[len(prefix):len(math) - len(suffix)].split())
+            if tex and not DOLLAR.search(tex):
+                return tex
+            return None
+    return None
+
+class MathPrerenderer(object):
+    """Renders formulas to inline SVG. The glyphs used by the formulas of
+    a text are defined once in the text, by the first formula using them,
+    with ids that start with a prefix unique to the text, so that texts
+    shown together, like the summaries of an index page, do not define
+    the same ids"""
+
+    def __init__(self, cache_dir, fontset, color, align, indent):
+        self.cache_dir = cache_dir
+        self.fontset = fontset
+        self.fill = 'currentColor' if color == 'inherit' else color
+        if align == 'left':
+            self.display_style = 'display: block; margin: 0.5em 0 0.5em %s' % indent
+        elif align == 'right':
+            self.display_style = 'display: block; margin: 0.5em %s 0.5em auto' % indent
+        else:
+            self.display_style = 'display: block; margin: 0.5em auto'
+        self.text2path = TextToPath()
+        # Layouts are in units of a hundredth of an em
+        self.prop = FontProperties(size=self.text2path.FONT_SCALE,
+                                   math_fontfamily=fontset)
+        self.layouts = {}
+
+    def cache_key(self, tex):
+        settings = (CACHE_VERSION, matplotlib.__version__, self.fontset, tex)
+        return hashlib.sha256(repr(settings).encode('utf-8')).hexdigest()
+
+    def layout(self, tex):
+        """Returns the layout of tex, from memory, the on-disk cache, or
+        mathtext, or None if mathtext cannot render it"""
+
+        key = self.cache_key(tex)
+        if key in self.layouts:
+            return self.layouts[key]
+
+        cache_file_path = os.path.join(self.cache_dir, key + '.pickle')
+        try:
+            with open(cache_file_path, 'rb') as cache_file:
+                layout = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            layout = self.render(tex)
+            self.save(cache_file_path, layout)
+
+        self.layouts[key] = layout
+        return layout
+
+    def render(self, tex):
+        """Lays out tex with mathtext. The layout has the width, height
+        and depth of the formula, the glyphs it uses, with their
+        positions and scales, the path data of each glyph, and the path
+        data of the rules, such as fraction bars"""
+
+        s = '$%s$' % tex
+        try:
+            width, height, depth, _, _ = self.text2path.mathtext_parser.parse(
+                s, self.text2path.DPI, self.prop)
+            glyphs, glyph_map, rects = self.text2path.get_glyphs_mathtext(
+                self.prop, s)
+        except Exception:
+            # Any failure, usually a ValueError for unsupported TeX, leaves
+            # the formula for MathJax
+            return None
+
+        return {
+            'width': float(width),
+            'height': float(height),
+            'depth': float(depth),
+            'glyphs': [(re.sub(r'[^\w-]', '_', glyph), float(x), float(y),
+                        float(scale))
+                       for glyph, x, y, scale in glyphs],
+            'paths': {re.sub(r'[^\w-]', '_', glyph): path_data(*path)
+                      for glyph, path in glyph_map.items()},
+            'rules': ''.join(path_data(*rect) for rect in rects),
+        }
+
+    def save(self, cache_file_path, layout):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir,
+                                             delete=False) as cache_file:
+                pickle.dump(layout, cache_file)
+            os.replace(cache_file.name, cache_file_path)
+        except OSError:
+            pass
+
+    def svg(self, math, display, defined, prefix):
+        """Returns the SVG for the contents of a math element, or None if it
+        cannot be rendered. defined holds the glyphs already defined in the
+        text, and is updated with the glyphs defined here; prefix starts
+        their ids"""
+
+        # A formula completed in a summary is followed by an ellipsis
+        ellipsis = ''
+        if math.rstrip().endswith(' ...'):
+            math, ellipsis = math.rstrip()[:-len(' ...')], ' ...'
+
+        tex = tex_formula(math)
+        if tex is None:
+            return None
+        layout = self.layout(tex)
+        if layout is None:
+            return None
+
+        width, height, depth = (layout['width'], layout['height'],
+                                layout['depth'])
+        em = self.text2path.FONT_SCALE
+        if display:
+            style = self.display_style
+        else:
+            style = 'vertical-align: %.2fem' % (-depth / em)
+
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" '
+                 'xmlns:xlink="http://www.w3.org/1999/xlink" '
+                 'width="%.2fem" height="%.2fem" viewBox="0 %s %s %s" '
+                 'fill="%s" style="%s" role="img" aria-label="%s">' % (
+                     width / em, height / em,
+                     number(depth - height), number(width), number(height),
+                     self.fill, style, html.escape(tex))]
+
+        definitions = []
+        for glyph, _, _, _ in layout['glyphs']:
+            if glyph not in defined:
+                defined.add(glyph)
+                definitions.append('<path id="%s-%s" d="%s"/>'
+                                   % (prefix, glyph, layout['paths'][glyph]))
+        if definitions:
+            parts.append('<defs>%s</defs>' % ''.join(definitions))
+
+        for glyph, x, y, scale in layout['glyphs']:
+            transform = 'translate(%s %s)' % (number(x), number(-y))
+            if scale != 1:
+                transform += ' scale(%g)' % round(scale, 4)
+            parts.append('<use xlink:href="#%s-%s" transform="%s"/>'
+                         % (prefix, glyph, transform))
+
+        if layout['rules']:
+            parts.append('<path d="%s"/>' % layout['rules'])
+
+        parts.append('</svg>')
+        return ''.join(parts) + ellipsis